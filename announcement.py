@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""announcement.py
+
+The "nearly sold out" announcement: the set of conferences with 1 to
+NEAR_SOLD_OUT_SEATS seats left, kept in an Announcement entity and in
+memcache together with its rendered text. Registrations update it as
+they cross the threshold; the /crons/set_announcement job reconciles it
+from a full query.
+
+Only needs ndb and memcache, so the cron, task and public handlers can
+use it without loading the Endpoints API.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Announcement, Conference
+import seats
+
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "announcements"
+MEMCACHE_NEAR_SOLD_OUT_KEY = "nearSoldOut"
+# conferences with 1..NEAR_SOLD_OUT_SEATS seats left are announced
+NEAR_SOLD_OUT_SEATS = 5
+
+
+def formatAnnouncement(names):
+    """Return the announcement text for nearly sold out conference names."""
+    if not names:
+        return ""
+    return """Last chance to attend! The following conferences
+                are nearly sold out:
+                {nearSoldOutConferences}""".format(
+                nearSoldOutConferences = ", ".join(sorted(names))
+            )
+
+
+def storeNearSoldOut(conferences):
+    """Put the near-sold-out set (webSafeKey -> name) in memcache along
+    with its rendered announcement, returning the announcement."""
+    announcement = formatAnnouncement(conferences.values())
+    # "" is cached too: it means "nothing to announce", not a miss
+    memcache.set_multi({ MEMCACHE_NEAR_SOLD_OUT_KEY: conferences,
+                         MEMCACHE_ANNOUNCEMENTS_KEY: announcement })
+    return announcement
+
+
+@ndb.transactional
+def changeNearSoldOut(webSafeKey, name):
+    """Add (name given) or remove (name None) a conference from the
+    stored near-sold-out set, returning the updated set."""
+    announcement = Announcement.get_or_insert('nearSoldOut')
+    conferences = announcement.conferences or {}
+    if name is None:
+        conferences.pop(webSafeKey, None)
+    else:
+        conferences[webSafeKey] = name
+    announcement.conferences = conferences
+    announcement.put()
+    return conferences
+
+
+def updateNearSoldOut(conference, seatsLeft, renamed=False):
+    """Keep the near-sold-out set current after a seat count change (or
+    a rename); only a threshold crossing, or renaming a listed
+    conference, costs more than a memcache get. A deleted conference is
+    removed by passing seatsLeft=0."""
+    if seatsLeft is None:
+        seatsLeft = seats.seatsAvailable(conference)
+    nearSoldOut = 0 < seatsLeft <= NEAR_SOLD_OUT_SEATS
+
+    webSafeKey = conference.key.urlsafe()
+    current = memcache.get(MEMCACHE_NEAR_SOLD_OUT_KEY)
+    if current is not None and (webSafeKey in current) == nearSoldOut:
+        if not (nearSoldOut and renamed):
+            return
+
+    conferences = changeNearSoldOut(
+        webSafeKey, conference.name if nearSoldOut else None)
+    storeNearSoldOut(conferences)
+
+
+def cacheAnnouncement():
+    """Rebuild the near-sold-out set from a full query & assign the
+    announcement to memcache; used by the reconciling cron job."""
+    nearSoldOutConferences = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEAR_SOLD_OUT_SEATS,
+        Conference.seatsAvailable > 0
+    )).fetch(
+        projection = [Conference.name]
+    )
+
+    conferences = dict( (c.key.urlsafe(), c.name)
+                        for c in nearSoldOutConferences )
+    Announcement(id='nearSoldOut', conferences=conferences).put()
+    return storeNearSoldOut(conferences)
+
+
+def getAnnouncement():
+    """Return the announcement from memcache OR an empty string; the
+    stored set is only read if memcache lost it."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        stored = ndb.Key(Announcement, 'nearSoldOut').get()
+        announcement = storeNearSoldOut(stored and stored.conferences or {})
+    return announcement
@@ -1,4 +1,15 @@
+import os
+
+# appstats keeps a trace of every request; instrument.py is what stays on
+# in production, so recording is only on for the dev server, or when a
+# deployment sets APPSTATS: 'on' under env_variables in app.yaml
+APPSTATS = (os.environ.get('APPSTATS') == 'on' or
+            os.environ.get('SERVER_SOFTWARE', '').startswith('Development'))
+
+
 def webapp_add_wsgi_middleware(app):
+    if not APPSTATS:
+        return app
     from google.appengine.ext.appstats import recording
     app = recording.appstats_wsgi_middleware(app)
     return app
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""applog.py
+
+Structured logging for hot paths. A call costs next to nothing unless
+its level is enabled: the level check comes first, sampling second, and
+the event is only rendered (as one JSON object) when a handler actually
+formats the record. Field values may be entities, messages or callables;
+none of them are stringified for records that are never written.
+
+    log = applog.getLogger(__name__)
+    log.debug('conference_data', data=data)
+    log.info('profile_created', sample=0.1, userId=user_id)
+
+Each event carries the App Engine request log id as "requestId", so all
+lines of one request can be correlated.
+
+"""
+
+import json
+import logging
+import os
+import random
+
+from google.appengine.ext import ndb
+from protorpc import messages
+from protorpc import protojson
+
+
+def _render(value):
+    """Turn a field value into something json.dumps() accepts."""
+    if callable(value):
+        value = value()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, ndb.Model):
+        data = value.to_dict()
+        if value.key:
+            data['key'] = value.key.urlsafe()
+        return data
+    if isinstance(value, messages.Message):
+        return json.loads(protojson.encode_message(value))
+    return value
+
+
+class _Event(object):
+    """_Event -- a log message rendered only when it is formatted"""
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        payload = dict( (name, _render(value))
+                        for name, value in self.fields.iteritems() )
+        payload['event'] = self.event
+        return json.dumps(payload, sort_keys=True, default=str)
+
+
+class StructuredLogger(object):
+    """StructuredLogger -- level-checked, sampled, lazily rendered events"""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level, event, sample=None, exc_info=False, **fields):
+        """Log event with fields; with sample (0..1) only that fraction
+        of calls is written, and the rate is recorded as "sampled".
+        exc_info adds the traceback of the exception being handled."""
+        if not self._logger.isEnabledFor(level):
+            return
+        if sample is not None:
+            if random.random() >= sample:
+                return
+            fields['sampled'] = sample
+        fields['requestId'] = os.environ.get('REQUEST_LOG_ID')
+        self._logger.log(level, _Event(event, fields), exc_info=exc_info)
+
+    def debug(self, event, sample=None, **fields):
+        self.log(logging.DEBUG, event, sample, **fields)
+
+    def info(self, event, sample=None, **fields):
+        self.log(logging.INFO, event, sample, **fields)
+
+    def warning(self, event, sample=None, **fields):
+        self.log(logging.WARNING, event, sample, **fields)
+
+    def error(self, event, sample=None, **fields):
+        self.log(logging.ERROR, event, sample, **fields)
+
+    def exception(self, event, sample=None, **fields):
+        """error() with the traceback; call from an exception handler."""
+        self.log(logging.ERROR, event, sample, exc_info=True, **fields)
+
+
+def getLogger(name=None):
+    """Return a StructuredLogger writing through logging.getLogger(name)."""
+    return StructuredLogger(name)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""bench_conversion.py
+
+Micro-benchmark of per-entity Conference -> ConferenceForm conversion:
+the old reflective all_fields() loop (with its per-field logging) against
+the precompiled converter used by ConferenceApi._copyConferenceToForm.
+
+Logging goes to a null stream at DEBUG, as on App Engine where every
+level is recorded. Usage:
+
+    APPENGINE_SDK=/path/to/google_appengine \
+        python benchmarks/bench_conversion.py [count]
+
+"""
+
+import datetime
+import logging
+import os
+import sys
+import timeit
+
+import sdk
+sdk.setup()
+
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference, ConferenceForm, Profile
+
+
+def legacyCopyConferenceToForm(conference, displayName):
+    """_copyConferenceToForm as it was before the precompiled converter."""
+    conferenceForm = ConferenceForm()
+
+    for field in conferenceForm.all_fields():
+        logging.debug("field name is: "+field.name)
+        if hasattr(conference, field.name):
+            # convert Date to date string: just copy others
+            if field.name.endswith('Date'):
+                setattr(conferenceForm, field.name, str(getattr(conference, field.name)))
+            else:
+                setattr(conferenceForm, field.name, getattr(conference, field.name))
+        elif field.name == "webSafeKey":
+            setattr(conferenceForm, field.name, conference.key.urlsafe())
+        if displayName:
+            setattr(conferenceForm, "organizerDisplayName", displayName)
+
+    logging.info( "conferenceForm is: " )
+    logging.info( conferenceForm )
+    conferenceForm.check_initialized()
+    return conferenceForm
+
+
+def makeConferences(count):
+    profile_key = ndb.Key(Profile, 'organizer@example.com')
+    return [ Conference( key = ndb.Key(Conference, index + 1, parent=profile_key),
+                         name = 'Conference %d' % index,
+                         description = 'A conference about things. ' * 4,
+                         organizerUserId = 'organizer@example.com',
+                         organizerDisplayName = 'Organizer',
+                         topics = ['Web Technologies', 'Programming Languages'],
+                         city = 'London',
+                         startDate = datetime.date(2015, 6, 1),
+                         month = 6,
+                         maxAttendees = 100,
+                         seatsAvailable = 42,
+                         endDate = datetime.date(2015, 6, 3) )
+             for index in range(count) ]
+
+
+def main(count=1000, repeat=5):
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+
+    conferences = makeConferences(count)
+    api = ConferenceApi()
+
+    def before():
+        for conference in conferences:
+            legacyCopyConferenceToForm(conference, 'Organizer')
+
+    def after():
+        for conference in conferences:
+            api._copyConferenceToForm(conference, 'Organizer')
+
+    for label, run in (('before', before), ('after', after)):
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        print '%-6s %8.1f us/entity  (%d entities, best of %d)' % (
+            label, best / count * 1e6, count, repeat)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""bench_logging.py
+
+Logging cost per queryConferences result: the per-field logging.debug /
+logging.info calls _copyConferenceToForm used to make, against the
+sampled, lazily rendered applog event it makes now. Both are measured on
+top of the bare converter, with records written to a null stream, at
+DEBUG (App Engine's default, every level recorded) and at INFO.
+
+    APPENGINE_SDK=/path/to/google_appengine \
+        python benchmarks/bench_logging.py [count]
+
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+import sdk
+sdk.setup()
+
+import applog
+from conference import CONFERENCE_TO_FORM
+from bench_conversion import makeConferences
+
+log = applog.getLogger('bench')
+
+
+def legacyLogging(form):
+    """The logging _copyConferenceToForm did per result before applog."""
+    for field in form.all_fields():
+        logging.debug("field name is: "+field.name)
+    logging.info( "conferenceForm is: " )
+    logging.info( form )
+
+
+def structuredLogging(form):
+    log.debug('conference_form', sample=0.01, form=form)
+
+
+def main(count=1000, repeat=5):
+    root = logging.getLogger()
+    root.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    conferences = makeConferences(count)
+
+    def measure(logResult):
+        def run():
+            for conference in conferences:
+                form = CONFERENCE_TO_FORM(conference)
+                if logResult:
+                    logResult(form)
+        return min(timeit.repeat(run, number=1, repeat=repeat)) / count
+
+    for level in (logging.DEBUG, logging.INFO):
+        root.setLevel(level)
+        baseline = measure(None)
+        for label, logResult in (('before', legacyLogging),
+                                 ('after', structuredLogging)):
+            print '%-5s %-6s %8.2f us/result logging  (%d results, best of %d)' % (
+                logging.getLevelName(level), label,
+                (measure(logResult) - baseline) * 1e6, count, repeat)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
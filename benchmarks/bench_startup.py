@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""bench_startup.py
+
+Cold start cost of each WSGI entry point: the time to import main.py,
+public.py and conference.py into a fresh interpreter (as a new instance
+does on its first request), and how many modules each pulls in. Every
+sample runs in its own subprocess, so nothing is already loaded; the
+median of the runs is reported.
+
+It also reports whether importing the module loaded Endpoints or
+conference.py. Cron, task and /public requests should load neither.
+
+    APPENGINE_SDK=/path/to/google_appengine \
+        python benchmarks/bench_startup.py [runs]
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = ('main', 'public', 'conference')
+
+# runs in the child: time one import after the SDK is set up
+PROBE = """
+import json, sys, time
+sys.path.insert(0, %(benchmarks)r)
+import sdk
+sdk.setup()
+before = set(sys.modules)
+started = time.time()
+import %(module)s
+seconds = time.time() - started
+print json.dumps({
+    'seconds': seconds,
+    'modules': len(set(sys.modules) - before),
+    'endpoints': 'endpoints' in sys.modules,
+    'conference': 'conference' in sys.modules,
+})
+"""
+
+
+def probe(module):
+    """Import module in a fresh interpreter; returns the child's report."""
+    code = PROBE % {'benchmarks': os.path.dirname(os.path.abspath(__file__)),
+                    'module': module}
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(runs=7):
+    for module in ENTRY_POINTS:
+        samples = [ probe(module) for run in range(runs) ]
+        print '%-10s %8.1f ms  %4d modules  endpoints=%-5s conference=%s' % (
+            module,
+            median([ sample['seconds'] for sample in samples ]) * 1e3,
+            median([ sample['modules'] for sample in samples ]),
+            samples[0]['endpoints'], samples[0]['conference'])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""loadtest.py
+
+Load-generation harness for ConferenceApi that runs on a plain Linux box.
+
+ndb, memcache and taskqueue all talk to App Engine through the API proxy,
+so the backend is swapped at that layer: the SDK's local service stubs
+(in-memory, or SQLite for the datastore) are registered instead of the
+production services and conference.py runs unmodified. Every RPC is
+counted with an API proxy hook and attributed to the endpoint that made
+it.
+
+A pool of simulated users drives createConference, queryConferences and
+registerForConference from several threads with a weighted mix, then
+p50/p95/p99 latency and RPCs per call are reported per endpoint:
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/loadtest.py \\
+        --threads 8 --requests 2000 --mix create=1,query=8,register=3
+
+"""
+
+import argparse
+import collections
+import datetime
+import random
+import threading
+import time
+
+import sdk
+sdk.setup()
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi, ConflictException, CONF_GET_REQUEST
+from models import Conference, ConferenceForm
+from models import ConferenceQueryForm, ConferenceQueryForms
+
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin', 'Sydney']
+TOPICS = ['Medical Innovations', 'Programming Languages',
+          'Web Technologies', 'Movie Making', 'Health and Nutrition']
+
+# per-thread simulated request: current user, endpoint and RPC counts
+_local = threading.local()
+
+
+def _currentUser():
+    return getattr(_local, 'user', None)
+
+
+def _countRpc(service, call, request, response):
+    rpcs = getattr(_local, 'rpcs', None)
+    if rpcs is not None:
+        rpcs[service] += 1
+
+
+def setUpServices(sqlite_path=None):
+    """Register local stubs for every service ConferenceApi uses."""
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    if sqlite_path:
+        bed.init_datastore_v3_stub(consistency_policy=policy,
+                                   datastore_file=sqlite_path,
+                                   use_sqlite=True)
+    else:
+        bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    # root_path makes the stub read queue.yaml (pull queues)
+    bed.init_taskqueue_stub(root_path=sdk.ROOT)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('loadtest', _countRpc)
+
+    # users come from the harness, not from OAuth tokens
+    endpoints.get_current_user = _currentUser
+    return bed
+
+
+class Stats(object):
+    """Stats -- latencies, failures and RPC counts per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.rpcs = collections.defaultdict(collections.Counter)
+
+    def record(self, endpoint, seconds, failed, rpcs):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if failed:
+                self.failures[endpoint] += 1
+            self.rpcs[endpoint].update(rpcs)
+
+    def report(self):
+        services = sorted(set(service for counts in self.rpcs.values()
+                              for service in counts))
+        print '%-24s %6s %6s %8s %8s %8s  %s' % (
+            'endpoint', 'calls', 'fail', 'p50 ms', 'p95 ms', 'p99 ms',
+            '  '.join('%s/call' % service for service in services))
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            calls = len(latencies)
+            print '%-24s %6d %6d %8.1f %8.1f %8.1f  %s' % (
+                endpoint, calls, self.failures[endpoint],
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                '  '.join('%*.2f' % (len(service) + 5,
+                                     float(self.rpcs[endpoint][service]) / calls)
+                          for service in services))
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def call(stats, endpoint, user, method, request):
+    """Run one API call as user, as if it were its own request."""
+    _local.user = users.User(email=user, _auth_domain='gmail.com')
+    _local.rpcs = collections.Counter()
+    # a fresh request: no NDB context cache, new service instance
+    ndb.get_context().clear_cache()
+    api = ConferenceApi()
+
+    failed = False
+    started = time.time()
+    try:
+        getattr(api, method)(request)
+    except ConflictException:
+        # sold out / already registered: expected under load
+        pass
+    except Exception:
+        failed = True
+    stats.record(endpoint, time.time() - started, failed, _local.rpcs)
+    _local.rpcs = None
+
+
+def createRequest(rng):
+    start = datetime.date(2016, 1, 1) + datetime.timedelta(days=rng.randrange(365))
+    return ConferenceForm(
+        name = 'Conference %d' % rng.randrange(10 ** 9),
+        description = 'Load test conference',
+        topics = rng.sample(TOPICS, 2),
+        city = rng.choice(CITIES),
+        startDate = start.isoformat(),
+        endDate = (start + datetime.timedelta(days=2)).isoformat(),
+        maxAttendees = rng.choice([10, 50, 200, 1000]),
+    )
+
+
+def queryRequest(rng):
+    filters = rng.choice([
+        [],
+        [ConferenceQueryForm(field='CITY', operator='EQ',
+                             value=rng.choice(CITIES))],
+        [ConferenceQueryForm(field='MONTH', operator='EQ',
+                             value=str(rng.randrange(1, 13)))],
+    ])
+    return ConferenceQueryForms(filters=filters, pageSize=20)
+
+
+def registerRequest(rng, conferenceKeys):
+    return CONF_GET_REQUEST.combined_message_class(
+        webSafeKey=rng.choice(conferenceKeys))
+
+
+def run(args):
+    bed = setUpServices(args.sqlite)
+    rng = random.Random(args.seed)
+    userPool = ['user%d@example.com' % index for index in range(args.users)]
+
+    # seed the catalogue (timed separately, as 'seed')
+    seedStats = Stats()
+    for index in range(args.conferences):
+        call(seedStats, 'seed', rng.choice(userPool), 'createConference',
+             createRequest(rng))
+    conferenceKeys = [ key.urlsafe() for key in
+                       Conference.query().fetch(keys_only=True) ]
+
+    mix = []
+    for part in args.mix.split(','):
+        name, weight = part.split('=')
+        mix.extend([name] * int(weight))
+
+    stats = Stats()
+    remaining = [args.requests]
+    lock = threading.Lock()
+
+    def worker(seed):
+        wrng = random.Random(seed)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            op = wrng.choice(mix)
+            user = wrng.choice(userPool)
+            if op == 'create':
+                call(stats, 'createConference', user, 'createConference',
+                     createRequest(wrng))
+            elif op == 'query':
+                call(stats, 'queryConferences', user, 'queryConferences',
+                     queryRequest(wrng))
+            elif op == 'register':
+                call(stats, 'registerForConference', user,
+                     'registerForConference',
+                     registerRequest(wrng, conferenceKeys))
+            else:
+                raise ValueError('Unknown operation in --mix: %s' % op)
+
+    threads = [ threading.Thread(target=worker, args=(rng.random(),))
+                for index in range(args.threads) ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    print '%d requests on %d threads in %.1fs (%.0f req/s)\n' % (
+        args.requests, args.threads, elapsed, args.requests / elapsed)
+    stats.report()
+    bed.deactivate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--conferences', type=int, default=100,
+                        help='conferences created before the timed run')
+    parser.add_argument('--mix', default='create=1,query=8,register=3',
+                        help='weighted operations: create, query, register')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='use a SQLite datastore file instead of memory')
+    parser.add_argument('--seed', type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
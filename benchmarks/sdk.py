@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+"""sdk.py
+
+Shared setup for the benchmarks: puts the App Engine SDK (from the
+APPENGINE_SDK environment variable) and the app itself on sys.path.
+
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(app_id='conference-bench'):
+    """Make google.appengine, endpoints and the app importable."""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+    try:
+        import dev_appserver
+    except ImportError:
+        sys.exit('Set APPENGINE_SDK to your google_appengine SDK directory.')
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('APPLICATION_ID', app_id)
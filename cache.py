@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Two-tier result cache for the conference API: a small in-process LRU in
+front of memcache. Entries are never deleted one by one; instead every
+key carries a generation number that writers bump, so stale entries
+simply stop being looked up and age out on their own.
+
+Entries may also be stored under a scope (e.g. the listings of one
+city), which has a generation of its own. Writers that know what they
+changed bump only the scopes affected; a plain bump() still
+invalidates everything.
+
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+class LocalLRU(object):
+    """LocalLRU -- bounded, thread-safe in-process cache with a TTL"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing/expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, evicting the least recently used entry.
+        ttl overrides the cache-wide TTL for this entry."""
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class GenerationalCache(object):
+    """GenerationalCache -- LRU + memcache cache invalidated by generation"""
+
+    STATS = ('localHits', 'memcacheHits', 'misses')
+
+    def __init__(self, namespace, local_size=200, local_ttl=30,
+                 memcache_ttl=300):
+        self.namespace = namespace
+        self.memcache_ttl = memcache_ttl
+        self.local = LocalLRU(local_size, local_ttl)
+        self._generation_key = '%s:generation' % namespace
+        self._stats_prefix = '%s:stats:' % namespace
+
+    @staticmethod
+    def makeKey(*parts):
+        """Return a short, stable digest for an arbitrary tuple of parts."""
+        return hashlib.md5(repr(parts)).hexdigest()
+
+    def generation(self):
+        """Return the current generation, starting one if there is none.
+        New generations start from the clock, so one never repeats after
+        memcache loses the counter (generations also appear in ETags)."""
+        generation = memcache.get(self._generation_key)
+        if generation is None:
+            start = int(time.time())
+            memcache.add(self._generation_key, start)
+            generation = memcache.get(self._generation_key) or start
+        return generation
+
+    def _scopeKey(self, scope):
+        return '%s:generation:%s' % (self.namespace, scope)
+
+    def version(self, scope=None):
+        """Return the generation entries of scope are currently stored
+        under: the cache's generation and, with a scope, the scope's own
+        (e.g. "1700000000.1700000042"). Either moving on changes it."""
+        if scope is None:
+            return str(self.generation())
+        keys = [ self._generation_key, self._scopeKey(scope) ]
+        # missing generations start from the clock, like generation()
+        start = int(time.time())
+        found = memcache.get_multi(keys)
+        missing = [ key for key in keys if key not in found ]
+        if missing:
+            memcache.add_multi(dict( (key, start) for key in missing ))
+            found.update(memcache.get_multi(missing))
+        return '.'.join( str(found.get(key, start)) for key in keys )
+
+    def bump(self, scopes=None):
+        """Invalidate every entry by moving on to a new generation or,
+        given scopes, only the entries stored under one of them."""
+        if scopes is None:
+            memcache.incr(self._generation_key, initial_value=int(time.time()))
+            return
+        memcache.offset_multi(dict( (self._scopeKey(scope), 1)
+                                    for scope in scopes ),
+                              initial_value=int(time.time()))
+
+    def _fullKey(self, key, version):
+        return '%s:%s:%s' % (self.namespace, version, key)
+
+    def _count(self, stat):
+        # fire and forget; counters are only used for tuning
+        memcache.Client().offset_multi_async(
+            {stat: 1}, key_prefix=self._stats_prefix, initial_value=0)
+
+    def get(self, key, scope=None):
+        """Return the value cached for key in the current generation."""
+        full_key = self._fullKey(key, self.version(scope))
+
+        value = self.local.get(full_key)
+        if value is not None:
+            self._count('localHits')
+            return value
+
+        value = memcache.get(full_key)
+        if value is not None:
+            self._count('memcacheHits')
+            self.local.set(full_key, value)
+            return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value, scope=None):
+        """Cache value under key for the current generation."""
+        full_key = self._fullKey(key, self.version(scope))
+        self.local.set(full_key, value)
+        try:
+            memcache.set(full_key, value, time=self.memcache_ttl)
+        except ValueError:
+            # too large for memcache; the local tier still has it
+            pass
+
+    def stats(self):
+        """Return hit/miss counters (across instances) and the generation."""
+        counters = memcache.get_multi(self.STATS,
+                                      key_prefix=self._stats_prefix)
+        stats = dict((stat, counters.get(stat, 0)) for stat in self.STATS)
+        stats['generation'] = self.generation()
+        return stats
+
+
+# queryConferences results, scoped by view and city (planner.cacheKey) and
+# invalidated whenever conferences/seats change; defined here so task
+# handlers can bump it without loading the API
+QUERY_CACHE = GenerationalCache('queryConferences',
+                                local_size=200,
+                                local_ttl=30,
+                                memcache_ttl=300)
@@ -13,54 +13,117 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
-import json
-import os
+import httplib
 import time
 
 import endpoints
-from protorpc import messages, message_types, remote
+from protorpc import messages, message_types, remote, protojson
 
 from google.appengine.api import taskqueue
-from google.appengine.api import memcache
-from google.appengine.api import urlfetch
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from models import Profile, ProfileMiniForm, ProfileForm, TeeShirtSize
-from models import Conference, ConferenceForm, ConferenceForms, ConferenceQueryForm, ConferenceQueryForms
-from models import BooleanMessage, ConflictException, StringMessage
-
-from utils import getUserId
+from models import Profile, ProfileMiniForm, ProfileForm, ProfileForms, TeeShirtSize
+from models import Registration, UserEmail
+from models import Conference, ConferenceForm, ConferenceForms, ConferenceQueryForms
+from models import ConferenceSummaryForm, ConferenceSummaryForms
+from models import ConferenceImportResultForm, ImportErrorForm
+from models import BooleanMessage, StringMessage
+from models import QueryCacheStatsForm, QueryPlanForm, SeatShard
+from models import ConferenceSearchForm, FacetForm, FacetForms, FacetValueForm
+from models import BatchRegistrationForm, RegistrationStatusForm, RegistrationStatusForms
+from models import ReservationStatusForm
+
+import announcement
+import applog
+from cache import QUERY_CACHE
+from converters import makeConverter
+import facets
+import instrument
+import planner
+import reservations
+import seats
+import tasks
+import textsearch
+
+from utils import getUserId, parseConferenceKey
 
 from settings import WEB_CLIENT_ID, FRONTING_WEB_CLIENT_ID
 
-import pdb, logging
+log = applog.getLogger(__name__)
 
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "announcements"
 MEETING_DEFAULTS = { "city": "Default City",
                      "maxAttendees": 0,
                      "seatsAvailable": 0,
                      "topics": [ "Default", "Topic" ], }
 
-OPERATORS = { 'EQ':   '=',
-              'GT':   '>',
-              'GTEQ': '>=',
-              'LT':   '<',
-              'LTEQ': '<=',
-              'NE':   '!=' }
-
-FIELDS =    { 'CITY': 'city',
-              'TOPIC': 'topics',
-              'MONTH': 'month',
-              'MAX_ATTENDEES': 'maxAttendees', }
+# bulk imports are validated & written this many conferences at a time
+# (one id range allocation, put_multi and taskqueue add per chunk)
+IMPORT_CHUNK = 100
+MAX_IMPORT_BATCH = 1000
+
+# upper bound for a single page of queryConferences results
+MAX_PAGE_SIZE = 100
+# entities read per page at most when a plan filters in memory
+MAX_SCAN = 1000
+
+# properties read by projection for queryConferenceSummaries; only for
+# filter shapes with an index covering these (planner.PROJECTED_SHAPES)
+SUMMARY_PROPERTIES = ('name', 'city', 'startDate', 'endDate', 'maxAttendees',
+                      'seatsAvailable', 'organizerDisplayName')
+
+# properties updateConference may change; the others are derived from
+# these or owned by the server
+UPDATE_FIELDS = ('name', 'description', 'topics', 'city', 'startDate',
+                 'endDate', 'maxAttendees')
+# changes to these need the search document / facet counts refreshed
+SEARCH_FIELDS = frozenset(['name', 'description', 'city', 'topics', 'month'])
+FACET_FIELDS = frozenset(['city', 'topics', 'month'])
+# changes to these only show in queryConferences' full forms: they are
+# neither in summaries nor filtered or sorted on
+FULL_VIEW_FIELDS = frozenset(['description'])
+
+# entity -> message converters, planned once at import time
+# (convert t-shirt string to Enum & Dates to date strings; copy others)
+PROFILE_TO_FORM = makeConverter(
+    Profile, ProfileForm,
+    transforms={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
+CONFERENCE_TO_FORM = makeConverter(
+    Conference, ConferenceForm,
+    transforms={'startDate': str, 'endDate': str},
+    computed={'webSafeKey': lambda conference: conference.key.urlsafe()})
+
+# batchRegistration limits; an xg transaction spans at most 25 entity
+# groups, i.e. one seat shard plus 24 attendee profiles
+MAX_BATCH_SIZE = 500
+BATCH_CHUNK = 24
+
+class ConflictException(endpoints.ServiceException):
+    """ConflictException - exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     webSafeKey=messages.StringField(1),
 )
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
+CONF_GET_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    webSafeKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
 @endpoints.api( name='conference', version='v1', scopes=[EMAIL_SCOPE],
                 allowed_client_ids=[ WEB_CLIENT_ID,
                                      FRONTING_WEB_CLIENT_ID,
@@ -71,21 +134,9 @@ class ConferenceApi(remote.Service):
 # - - - Profile Objects - - - - - - - - - - - - - - - - - - -
     def _copyProfileToForm(self, profile):
         """Copy relevant fields from Profile to ProfileForm."""
-        profileForm = ProfileForm()
-        for field in profileForm.all_fields():
-            if hasattr(profile, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr( profileForm,
-                             field.name,
-                             getattr(TeeShirtSize, getattr(profile, field.name)) )
-                else:
-                    setattr( profileForm,
-                             field.name,
-                             getattr(profile, field.name) )
-        profileForm.check_initialized()
-        return profileForm
+        return PROFILE_TO_FORM(profile)
 
+    @instrument.span('_getProfileFromUser')
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
         # step 1: make sure user is authed
@@ -93,10 +144,20 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
+        # the service is instantiated per request, so this memo makes sure
+        # the user id lookup and Profile read happen at most once per call
+        memo = getattr(self, '_profileMemo', None)
+        if memo and memo[0] == user:
+            return memo[1]
+        profile = self._loadProfile(user)
+        self._profileMemo = (user, profile)
+        return profile
+
+    def _loadProfile(self, user):
+        """Read (or create) the Profile of an authenticated user."""
         # get user id by calling getUserId(user)
         user_id = getUserId(user)
-        logging.debug( "user_id is: " )
-        logging.debug( user_id )
+        log.debug('profile_load', userId=user_id)
 
         # create a new key of kind Profile from the id
         profile_key = ndb.Key(Profile, user_id)
@@ -114,10 +175,12 @@ class ConferenceApi(remote.Service):
                 mainEmail    = user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            # save new profile to datastore
-            returned_profile_key = profile.put()
-            print "returned_profile_key is: "
-            print returned_profile_key
+            # save new profile to datastore, along with the email -> user id
+            # mapping used by getUserId(id_type="custom")
+            ndb.put_multi([profile, UserEmail(id=user.email(), userId=user_id)])
+            log.info('profile_created', profileKey=profile_key)
+        elif profile.conferenceKeysToAttend:
+            profile = tasks.migrateRegistrations(profile_key)
         return profile
 
     def _doProfile(self, save_request=None):
@@ -126,47 +189,47 @@ class ConferenceApi(remote.Service):
         profile = self._getProfileFromUser()
         # if saveProfile(), process user-modifiable fields
         if save_request:
-            print "save_request!"
+            oldDisplayName = profile.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     value = getattr(save_request, field)
                     if value:
-                        print "setting attr in _doProfile!"
                         setattr(profile, field, str(value))
+            log.debug('profile_saved', profile=profile)
             # remember, you have to .put() to finalize any changes made!^^
             profile.put()
+            # conferences carry a copy of the organizer's displayName
+            if profile.displayName != oldDisplayName:
+                taskqueue.add(params={'userId': profile.key.id()},
+                              url='/tasks/propagate_display_name')
 
         # return the ProfileForm
-        print "in _doProfile, profile is: "
-        print profile
         return self._copyProfileToForm(profile)
 
 # - - - Profile Endpoints - - - - - - - - - - - - - -
     @endpoints.method( message_types.VoidMessage, ProfileForm,
                        path='profile', http_method='GET', name='getProfile' )
+    @instrument.endpoint
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
     @endpoints.method( ProfileMiniForm, ProfileForm,
                    path='profile', http_method='POST', name='saveProfile' )
+    @instrument.endpoint
     def saveProfile(self, request):
         """Update & return user profile."""
         # request contains only fields in the ProfileMiniForm.
         # Pass this to _doProfile function, which will return profile info
         # from the datastore.
-        print request
+        log.debug('save_profile', request=request)
         return self._doProfile(request)
 
 # - - - Conference Objects - - - - - - - - - - - - - -
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # guard clauses / load prerequisites
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    @staticmethod
+    def _conferenceData(request):
+        """Validate a ConferenceForm and turn it into Conference properties,
+        filling in defaults & derived fields (also on the form itself)."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required!")
 
@@ -176,10 +239,8 @@ class ConferenceApi(remote.Service):
             field.name: getattr(request, field.name) for field in request.all_fields()
             }
         del data['webSafeKey']
-        del data['organizerDisplayName']
 
-        logging.debug( "data was: " )
-        logging.debug( data )
+        log.debug('conference_request', data=data)
         # add default values for those mission (both data model & outbound Message)
         for default in MEETING_DEFAULTS:
             if data[default] in (None, []):
@@ -187,13 +248,9 @@ class ConferenceApi(remote.Service):
                 setattr(request, default, MEETING_DEFAULTS[default])
 
         # convert dates from strings to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        data['startDate'] = ConferenceApi._parseDate(data['startDate'])
+        data['endDate'] = ConferenceApi._parseDate(data['endDate'])
+        data['month'] = data['startDate'].month if data['startDate'] else 0
 
         # set seatsAvailable to be the same as maxAtendees on creation
         # both for data model & outbound Message
@@ -201,6 +258,29 @@ class ConferenceApi(remote.Service):
             data['seatsAvailable'] = data['maxAttendees']
             setattr(request, "seatsAvailable", data["maxAttendees"] )
 
+        return data
+
+    @staticmethod
+    def _parseDate(value):
+        """Turn a YYYY-MM-DD string (or longer ISO timestamp) into a date;
+        empty values become None."""
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value[:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException("Dates must be given as YYYY-MM-DD.")
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # guard clauses / load prerequisites
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._conferenceData(request)
+
         # make key from user ID
         profile_key = ndb.Key(Profile, user_id)
 
@@ -212,134 +292,595 @@ class ConferenceApi(remote.Service):
 
         data['key'] = conference_key
         data['organizerUserId'] = request.organizerUserId = user_id
-
-        logging.debug( "data is: " )
-        logging.debug( data )
-
-        # create Conference & return modified ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(
-            params={
-                'email': user.email(),
-                'conferenceInfo': repr(request)
-            },
-            url='/tasks/send_confirmation_email'
-        )
+        # denormalized so listings need no Profile lookups
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            self._getProfileFromUser().displayName
+
+        log.debug('conference_data', data=data)
+
+        # create Conference with its seat shards & return modified ConferenceForm
+        conference = Conference(**data)
+        ndb.put_multi([conference] + seats.initShards(conference))
+        QUERY_CACHE.bump(planner.changeScopes([conference.city]))
+        textsearch.indexConferences([conference])
+        facets.scheduleCount([conference.key])
+        # queue a compact confirmation for the batched mailer cron,
+        # without waiting on the RPC
+        taskqueue.Queue(tasks.CONFIRMATION_QUEUE).add_async(
+            tasks.confirmationTask(conference, user.email()))
 
         return request
 
+    @staticmethod
+    def _importConferences(records, user, profile):
+        """Create conferences for profile from an iterable of (ConferenceForm,
+        parse error) pairs, IMPORT_CHUNK at a time; returns a
+        ConferenceImportResultForm with per-record errors & throughput.
+        Shared by importConferences and the /admin/import_conferences upload."""
+        started = time.time()
+        result = ConferenceImportResultForm(imported=0)
+
+        chunk = []
+        cities = set()
+        for index, (form, error) in enumerate(records):
+            if error is None:
+                try:
+                    chunk.append(ConferenceApi._conferenceData(form))
+                except endpoints.BadRequestException as e:
+                    error = str(e)
+            if error is not None:
+                result.errors.append(ImportErrorForm(index=index, message=error))
+            if len(chunk) == IMPORT_CHUNK:
+                cities.update( data['city'] for data in chunk )
+                result.imported += ConferenceApi._storeImported(chunk, user, profile)
+                chunk = []
+        if chunk:
+            cities.update( data['city'] for data in chunk )
+            result.imported += ConferenceApi._storeImported(chunk, user, profile)
+
+        if result.imported:
+            QUERY_CACHE.bump(planner.changeScopes(cities))
+        result.seconds = time.time() - started
+        result.recordsPerSecond = (result.imported + len(result.errors)) / \
+                                  max(result.seconds, 0.001)
+        return result
+
+    @staticmethod
+    def _storeImported(chunk, user, profile):
+        """Write one chunk of validated conference data: a single id range
+        allocation, one put_multi and one batch of confirmation tasks."""
+        first, last = Conference.allocate_ids(size=len(chunk), parent=profile.key)
+
+        conferences = []
+        entities = []
+        for conference_id, data in zip(range(first, last + 1), chunk):
+            data['key'] = ndb.Key(Conference, conference_id, parent=profile.key)
+            data['organizerUserId'] = profile.key.id()
+            data['organizerDisplayName'] = profile.displayName
+            conference = Conference(**data)
+            conferences.append(conference)
+            entities.append(conference)
+            entities.extend(seats.initShards(conference))
+
+        ndb.put_multi(entities)
+        textsearch.indexConferences(conferences)
+        facets.scheduleCount([ imported.key for imported in conferences ])
+        taskqueue.Queue(tasks.CONFIRMATION_QUEUE).add(
+            [ tasks.confirmationTask(imported, user.email())
+              for imported in conferences ])
+        return len(conferences)
+
+    @staticmethod
+    def _conferenceChanges(request):
+        """Return the properties a (partial) ConferenceForm sets, validated;
+        fields left out (None, or an empty topic list) stay as they are."""
+        changes = {}
+        for field in UPDATE_FIELDS:
+            value = getattr(request, field)
+            if value is not None and value != []:
+                changes[field] = value
+
+        if 'name' in changes and not changes['name'].strip():
+            raise endpoints.BadRequestException("Conference 'name' field required!")
+        if changes.get('maxAttendees', 0) < 0:
+            raise endpoints.BadRequestException("'maxAttendees' cannot be negative.")
+        for field in ('startDate', 'endDate'):
+            if field in changes:
+                changes[field] = ConferenceApi._parseDate(changes[field])
+        if 'startDate' in changes:
+            startDate = changes['startDate']
+            changes['month'] = startDate.month if startDate else 0
+        return changes
+
+    def _getConference(self, webSafeKey):
+        """Return the conference for webSafeKey; raises NotFound for
+        missing conferences and keys that are malformed or not one."""
+        conference_key = parseConferenceKey(webSafeKey)
+        conference = conference_key and conference_key.get()
+        if not conference:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % webSafeKey)
+        return conference
+
+    def _organizedConference(self, webSafeKey):
+        """Return the conference for webSafeKey if the caller organizes it;
+        raises otherwise."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        conference = self._getConference(webSafeKey)
+        if conference.organizerUserId != user_id:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can change the conference.')
+        return conference
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _updateConferenceTxn(conference_key, changes):
+        """Apply changes to the stored Conference and, if maxAttendees
+        changes, its seat shards. Only what actually changed is put;
+        returns (conference, names of changed properties)."""
+        conference = conference_key.get()
+        if not conference:
+            raise endpoints.NotFoundException('No conference found.')
+        changed = set( name for name, value in changes.items()
+                       if getattr(conference, name) != value )
+        if not changed:
+            return (conference, changed)
+
+        entities = [conference]
+        if 'maxAttendees' in changed:
+            # free seats move by as much as the capacity does; seats that
+            # are registered or held stay taken
+            delta = changes['maxAttendees'] - (conference.maxAttendees or 0)
+            try:
+                shards, total = seats.resize(conference, delta)
+            except seats.SeatsTaken:
+                raise ConflictException(
+                    "More seats are taken than the new 'maxAttendees'.")
+            entities.extend(shards)
+            if conference.seatsAvailable != total:
+                conference.seatsAvailable = total
+                changed.add('seatsAvailable')
+
+        for name in changed & set(changes):
+            setattr(conference, name, changes[name])
+        ndb.put_multi(entities)
+        return (conference, changed)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _deleteConferenceTxn(conference_key):
+        """Delete a Conference with its seat shards, returning it; its
+        registrations are removed afterwards by a task that only runs if
+        this commits."""
+        conference = conference_key.get()
+        if not conference:
+            raise endpoints.NotFoundException('No conference found.')
+        ndb.delete_multi([conference_key] + seats.shardKeys(conference))
+        taskqueue.add(params={'webSafeKey': conference_key.urlsafe()},
+                      url='/tasks/delete_registrations',
+                      transactional=True)
+        return conference
+
+    @instrument.span('_copyConferenceToForm')
     def _copyConferenceToForm(self, conference, displayName):
         """Copy relevant fields from Conference to ConferenceForm"""
-        conferenceForm = ConferenceForm()
-
-        for field in conferenceForm.all_fields():
-            logging.debug("field name is: "+field.name)
-            if hasattr(conference, field.name):
-                # convert Date to date string: just copy others
-                if field.name.endswith('Date'):
-                    setattr(conferenceForm, field.name, str(getattr(conference, field.name)))
-                else:
-                    setattr(conferenceForm, field.name, getattr(conference, field.name))
-            elif field.name == "webSafeKey":
-                setattr(conferenceForm, field.name, conference.key.urlsafe())
-            if displayName:
-                setattr(conferenceForm, "organizerDisplayName", displayName)
-
-        logging.info( "conferenceForm is: " )
-        logging.info( conferenceForm )
-        conferenceForm.check_initialized()
+        conferenceForm = CONFERENCE_TO_FORM(conference)
+        if displayName:
+            conferenceForm.organizerDisplayName = displayName
+        # once per result: sampled, and rendered only if written
+        log.debug('conference_form', sample=0.01, form=conferenceForm)
         return conferenceForm
 
 # - - - Querying Helper Methods - - - - - - - - - - - - - -
+    @instrument.span('_getQuery')
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        conferences = Conference.query()
+        """Return the cheapest QueryPlan for the submitted filters."""
         inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            conferences = conferences.order(Conference.name)
+        return planner.plan(inequality_filter, filters,
+                            paged=request.pageSize is not None)
+
+    def _runPlan(self, plan, pageSize, pageToken, **options):
+        """Run a QueryPlan, returning (entities, nextPageToken) like
+        _fetchPage(); without a pageSize every match is returned."""
+        if not plan.postFilters:
+            if pageSize is not None:
+                return self._fetchPage(plan.query, pageSize, pageToken,
+                                       **options)
+            conferences = plan.query.fetch(**options)
+        elif pageSize is None:
+            conferences = [ conference for conference in plan.query
+                            if plan.matches(conference) ]
         else:
-            conferences = conferences.\
-                order(ndb.GenericProperty(inequality_filter)).\
-                order(Conference.name)
-
-        for filtre in filters:
-            if filtre["field"] in ["month", "maxAttendees"]:
-                filtre["value"] = int(filtre["value"])
-            formatted_query = ndb.query.FilterNode( filtre["field"],
-                                                    filtre["operator"],
-                                                    filtre["value"] )
-            conferences = conferences.filter(formatted_query)
-        return conferences
+            return self._fetchFilteredPage(plan, pageSize, pageToken)
+
+        if plan.sortInMemory:
+            conferences.sort(key=plan.sortInMemory)
+        return (conferences, None)
+
+    def _fetchFilteredPage(self, plan, pageSize, pageToken):
+        """Fill a page from a post-filtered plan. At most MAX_SCAN entities
+        are read per call, so a page may come back short (but with a
+        nextPageToken) when few conferences match."""
+        if pageSize <= 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive.")
+        pageSize = min(pageSize, MAX_PAGE_SIZE)
+
+        try:
+            cursor = Cursor(urlsafe=pageToken) if pageToken else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+
+        it = plan.query.iter(start_cursor=cursor, produce_cursors=True,
+                             batch_size=min(MAX_SCAN, pageSize * 4))
+        conferences = []
+        scanned = 0
+        for conference in it:
+            scanned += 1
+            if plan.matches(conference):
+                conferences.append(conference)
+            if len(conferences) == pageSize or scanned == MAX_SCAN:
+                if it.probably_has_next():
+                    return (conferences, it.cursor_after().urlsafe())
+                break
+        return (conferences, None)
 
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
-        formatted_filters = []
-        inequality_field = None
-
-        for f in filters:
-            filtre = {field.name: getattr(f, field.name) for field in f.all_fields()}
-
-            try:
-                filtre["field"] = FIELDS[filtre["field"]]
-                filtre["operator"] = OPERATORS[filtre["operator"]]
-            except KeyError:
-                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
-
-            # Every operation except "=" is an inequality
-            if filtre["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtre["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtre["field"]
-
-            formatted_filters.append(filtre)
-        return (inequality_field, formatted_filters)
+        try:
+            return planner.formatFilters(filters)
+        except planner.FilterError as e:
+            raise endpoints.BadRequestException(str(e))
+
+    def _queryCacheKey(self, request, view='full'):
+        """Return a cache key for the request that ignores filter order,
+        and the cache scope it is stored under."""
+        try:
+            return planner.cacheKey(request, view)
+        except planner.FilterError as e:
+            raise endpoints.BadRequestException(str(e))
+
+    def _copySummaryToForm(self, conference, fixed):
+        """Copy a projected Conference into a ConferenceSummaryForm;
+        properties pinned by equality filters come from fixed instead."""
+        form = ConferenceSummaryForm(webSafeKey=conference.key.urlsafe())
+        for name in SUMMARY_PROPERTIES:
+            value = fixed[name] if name in fixed else getattr(conference, name)
+            if name.endswith('Date') and value is not None:
+                value = str(value)
+            setattr(form, name, value)
+        return form
+
+    def _fetchPage(self, query, pageSize, pageToken, **options):
+        """Fetch one page of query results, returning (entities, nextPageToken).
+        nextPageToken is None once the last page has been reached; options
+        (e.g. keys_only) are passed on to fetch_page()."""
+        return self._fetchPageAsync(query, pageSize, pageToken,
+                                    **options).get_result()
+
+    @ndb.tasklet
+    def _fetchPageAsync(self, query, pageSize, pageToken, **options):
+        """Tasklet version of _fetchPage()."""
+        if pageSize <= 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive.")
+        pageSize = min(pageSize, MAX_PAGE_SIZE)
+
+        try:
+            cursor = Cursor(urlsafe=pageToken) if pageToken else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+
+        entities, next_cursor, more = yield query.fetch_page_async(
+            pageSize, start_cursor=cursor, **options)
+        if more and next_cursor:
+            raise ndb.Return((entities, next_cursor.urlsafe()))
+        raise ndb.Return((entities, None))
 
 # - - - Conference Endpoints - - - - - - - - - - - - - -
     @endpoints.method( ConferenceForm, ConferenceForm,
                        path='conference', http_method='POST', name='createConference' )
+    @instrument.endpoint
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    @endpoints.method( ConferenceForms, ConferenceImportResultForm,
+                       path='conferences/import',
+                       http_method='POST',
+                       name='importConferences' )
+    @instrument.endpoint
+    def importConferences(self, request):
+        """Create many conferences at once, reporting per-record errors.
+        For larger catalogs stream CSV/JSON lines to /admin/import_conferences."""
+        if len(request.items) > MAX_IMPORT_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per batch.' % MAX_IMPORT_BATCH)
+        profile = self._getProfileFromUser()
+        return self._importConferences(
+            ((form, None) for form in request.items),
+            endpoints.get_current_user(), profile)
+
+    @endpoints.method( ConferenceForm, ConferenceForm,
+                       path='conference/{webSafeKey}',
+                       http_method='PUT',
+                       name='updateConference' )
+    @instrument.endpoint
+    def updateConference(self, request):
+        """Update a conference (organizer only); only the fields given are
+        changed, month and seatsAvailable are recomputed from them."""
+        conference = self._organizedConference(request.webSafeKey)
+        changes = self._conferenceChanges(request)
+        if 'maxAttendees' in changes:
+            conference = seats.ensureShards(conference)
+        oldCity = conference.city
+        conference, changed = self._updateConferenceTxn(conference.key,
+                                                        changes)
+
+        # invalidate what depends on the changed properties only; an
+        # update that changes nothing keeps every cache (and the ETag).
+        # Cached queries are scoped by city and view, so only listings of
+        # the old and new city (and unfiltered ones) are dropped, and
+        # summaries keep their entries through description edits
+        if changed:
+            views = planner.CACHE_VIEWS if changed - FULL_VIEW_FIELDS \
+                else ('full',)
+            QUERY_CACHE.bump(planner.changeScopes([oldCity, conference.city],
+                                                  views))
+        if changed & SEARCH_FIELDS:
+            textsearch.indexConferences([conference])
+        if changed & FACET_FIELDS:
+            facets.scheduleCount([conference.key])
+        if 'seatsAvailable' in changed:
+            seats.cacheTotal(conference.key, conference.seatsAvailable)
+            if conference.seatsAvailable > 0:
+                # new seats go to the waitlist first, if any
+                reservations.schedulePromotion(conference.key)
+        if changed & set(['seatsAvailable', 'name']):
+            # the stored seatsAvailable is only exact if it was just set
+            seatsLeft = conference.seatsAvailable \
+                if 'seatsAvailable' in changed else None
+            announcement.updateNearSoldOut(conference, seatsLeft,
+                                           renamed='name' in changed)
+        return self._copyConferencesToForms([conference])[0]
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{webSafeKey}',
+            http_method='DELETE', name='deleteConference')
+    @instrument.endpoint
+    def deleteConference(self, request):
+        """Delete a conference (organizer only); registrations are cleaned
+        up in the background."""
+        conference = self._organizedConference(request.webSafeKey)
+        conference = self._deleteConferenceTxn(conference.key)
+
+        QUERY_CACHE.bump(planner.changeScopes([conference.city]))
+        textsearch.unindexConferences([conference.key])
+        facets.scheduleCount([conference.key])
+        seats.cacheTotal(conference.key, None)
+        # no seats left means "not nearly sold out": drops it from the set
+        announcement.updateNearSoldOut(conference, 0)
+        return BooleanMessage(data=True)
+
     @endpoints.method( ConferenceQueryForms, ConferenceForms,
                        path='queryConferences',
                        http_method='POST',
                        name='queryConferences' )
+    @instrument.endpoint
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # fetch organizer displayName from profiles to return full ConferenceForms.
-        organizers = [ (ndb.Key(Profile, conference.organizerUserId)) \
-                        for conference in conferences
-                     ]
-        profiles = ndb.get_multi(organizers)
-
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Query for conferences, a page at a time if 'pageSize' is given.
+        With 'explain' set, return the chosen query plan instead."""
+        if request.explain:
+            plan = self._getQuery(request)
+            return ConferenceForms(plan=QueryPlanForm(
+                strategy = plan.strategy,
+                index = plan.index,
+                postFilters = plan.describe(),
+                estimatedCost = plan.cost,
+            ))
+
+        cache_key, scope = self._queryCacheKey(request)
+        cached = QUERY_CACHE.get(cache_key, scope)
+        if cached is not None:
+            return protojson.decode_message(ConferenceForms, cached)
+
+        forms = self._queryConferences(request)
+        QUERY_CACHE.set(cache_key, protojson.encode_message(forms), scope)
+        return forms
+
+    @endpoints.method( ConferenceQueryForms, ConferenceSummaryForms,
+                       path='queryConferenceSummaries',
+                       http_method='POST',
+                       name='queryConferenceSummaries' )
+    @instrument.endpoint
+    def queryConferenceSummaries(self, request):
+        """Query for conferences, returning only what listings display."""
+        cache_key, scope = self._queryCacheKey(request, 'summary')
+        cached = QUERY_CACHE.get(cache_key, scope)
+        if cached is not None:
+            return protojson.decode_message(ConferenceSummaryForms, cached)
+
+        forms = self._queryConferenceSummaries(request)
+        QUERY_CACHE.set(cache_key, protojson.encode_message(forms), scope)
+        return forms
+
+    def _queryConferenceSummaries(self, request):
+        """Run a summary query, uncached; also serves /public/conferences."""
+        # the datastore refuses to project equality-filtered properties;
+        # their value is known anyway
+        inequality_filter, filters = self._formatFilters(request.filters)
+        fixed = dict( (f["field"], f["value"]) for f in filters
+                      if f["operator"] == "=" )
+        projection = [ name for name in SUMMARY_PROPERTIES
+                       if name not in fixed ]
+
+        # plans filtering or sorting in memory need whole entities, and
+        # only some composite shapes have an index for the projection
+        plan = self._getQuery(request)
+        options = {}
+        if plan.projectable:
+            options['projection'] = projection
+        conferences, nextPageToken = self._runPlan(
+            plan, request.pageSize, request.pageToken, **options)
+
+        return ConferenceSummaryForms(
+            items = [ self._copySummaryToForm(conference, fixed) \
+                      for conference in conferences ],
+            nextPageToken = nextPageToken
+        )
 
+    @endpoints.method( CONF_GET_REQUEST, ConferenceForm,
+                       path='conference/{webSafeKey}',
+                       http_method='GET',
+                       name='getConference' )
+    @instrument.endpoint
+    def getConference(self, request):
+        """Return the full conference for a webSafeKey (detail view)."""
+        conference = self._getConference(request.webSafeKey)
+
+        displayName = None
+        if conference.organizerDisplayName is None:
+            organizer = ndb.Key(Profile, conference.organizerUserId).get()
+            displayName = organizer and organizer.displayName
+        return self._copyConferenceToForm(conference, displayName)
+
+    def _queryConferences(self, request):
+        """Run queryConferences against the datastore, bypassing the cache."""
+        return self._queryConferencesAsync(request).get_result()
+
+    @ndb.tasklet
+    def _queryConferencesAsync(self, request):
+        """Tasklet behind _queryConferences."""
+        plan = self._getQuery(request)
+
+        # run the query exactly once; a page when asked for, otherwise all
+        # of it, converted batch by batch as the results stream in
+        if request.pageSize is not None:
+            if plan.postFilters:
+                conferences, nextPageToken = self._fetchFilteredPage(
+                    plan, request.pageSize, request.pageToken)
+            else:
+                conferences, nextPageToken = yield self._fetchPageAsync(
+                    plan.query, request.pageSize, request.pageToken)
+            forms = yield self._copyConferencesToFormsAsync(conferences)
+        else:
+            @ndb.tasklet
+            def convert(conference):
+                if not plan.matches(conference):
+                    raise ndb.Return(None)
+                form = yield self._conferenceFormAsync(conference)
+                raise ndb.Return((conference, form))
+
+            results = yield plan.query.map_async(convert)
+            results = [ result for result in results if result ]
+            if plan.sortInMemory:
+                results.sort(key=lambda result: plan.sortInMemory(result[0]))
+            forms = [ form for conference, form in results ]
+            nextPageToken = None
+
+        raise ndb.Return(ConferenceForms(
+            items = forms,
+            nextPageToken = nextPageToken
+        ))
+
+    def _copyConferencesToForms(self, conferences):
+        """Return a ConferenceForm per Conference, batching any Profile
+        lookups."""
+        return self._copyConferencesToFormsAsync(conferences).get_result()
+
+    @ndb.tasklet
+    def _copyConferencesToFormsAsync(self, conferences):
+        """Tasklet version of _copyConferencesToForms()."""
         # return individual ConferenceForm object per Conference
-        # (another dict comprehension!)
+        forms = yield [ self._conferenceFormAsync(conference)
+                        for conference in conferences ]
+        raise ndb.Return(forms)
+
+    @ndb.tasklet
+    def _conferenceFormAsync(self, conference):
+        """Tasklet converting one Conference into a ConferenceForm."""
+        # organizerDisplayName is stored on Conference; only conferences
+        # created before it was denormalized need their organizer's Profile.
+        # Concurrent lookups are batched by ndb, and repeated organizers
+        # come from the context cache
+        displayName = None
+        if conference.organizerDisplayName is None:
+            organizer = yield ndb.Key(Profile,
+                                      conference.organizerUserId).get_async()
+            displayName = organizer and organizer.displayName
+        raise ndb.Return(self._copyConferenceToForm(conference, displayName))
+
+    @endpoints.method( ConferenceSearchForm, ConferenceForms,
+                       path='conferences/search',
+                       http_method='POST',
+                       name='searchConferences' )
+    @instrument.endpoint
+    def searchConferences(self, request):
+        """Full-text search over conference names and descriptions,
+        with facet counts by city, topic and month over all matches."""
+        refinements = []
+        if request.city:
+            refinements.append(('city', request.city))
+        if request.topic:
+            refinements.append(('topic', request.topic))
+        if request.month:
+            refinements.append(('month', unicode(request.month)))
+
+        pageSize = request.pageSize or MAX_PAGE_SIZE
+        if pageSize <= 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive.")
+        try:
+            results = textsearch.INDEX.search(
+                request.query, refinements, min(pageSize, MAX_PAGE_SIZE),
+                request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+
+        # the index can briefly list conferences that no longer exist
+        conferences = [ conference for conference in ndb.get_multi(
+                            [ ndb.Key(urlsafe=docId)
+                              for docId in results.docIds ])
+                        if conference ]
         return ConferenceForms(
-            items = [ self._copyConferenceToForm(
-                            conference,
-                            names[conference.organizerUserId]
-                        ) for conference in conferences
-                    ]
+            items = self._copyConferencesToForms(conferences),
+            nextPageToken = results.nextPageToken,
+            facets = [ FacetForm(field=facet, values=[
+                           FacetValueForm(value=value, count=count)
+                           for value, count in results.facets[facet] ])
+                       for facet in textsearch.FACETS ]
         )
 
+    @endpoints.method( message_types.VoidMessage, FacetForms,
+                       path='conferences/facets',
+                       http_method='GET',
+                       name='getFacetCounts' )
+    @instrument.endpoint
+    def getFacetCounts(self, request):
+        """Return how many conferences there are per city, topic and month."""
+        counts = facets.facetCounts()
+        return FacetForms(items = [
+            FacetForm(field=dimension, values=[
+                FacetValueForm(value=value, count=count)
+                for value, count in counts.get(dimension, []) ])
+            for dimension, prop in facets.DIMENSIONS ])
+
+    @endpoints.method( message_types.VoidMessage, QueryCacheStatsForm,
+                       path='queryConferences/cacheStats',
+                       http_method='GET',
+                       name='getQueryCacheStats' )
+    @instrument.endpoint
+    def getQueryCacheStats(self, request):
+        """Return hit/miss counters for the queryConferences cache."""
+        return QueryCacheStatsForm(**QUERY_CACHE.stats())
+
     @endpoints.method( message_types.VoidMessage, ConferenceForms,
                       path="getConferencesCreated",
                       http_method="POST",
                       name="getConferencesCreated" )
+    @instrument.endpoint
     def getConferencesCreated(self, request):
         # guard clauses / load prerequisites
         user = endpoints.get_current_user()
@@ -348,45 +889,95 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
         ### They call this an "ancestor/descendant query":
         conferencesOfUser = Conference.query(ancestor=ndb.Key(Profile, user_id))
+        # each batch is converted while the next one is being fetched
         return ConferenceForms(
-            items = [ self._copyConferenceToForm(conference, "") \
-                      for conference in conferencesOfUser
-                    ]
+            items = conferencesOfUser.map_async(
+                self._conferenceFormAsync).get_result()
         )
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrument.endpoint
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        # TODO:
-        # step 1: get user profile
+        # step 1: get user profile (this also migrates legacy registrations)
         profile = self._getProfileFromUser()
 
-        # step 2: get conferenceKeysToAttend from profile.
-        # to make a ndb key from webSafe key you can use:
-        # ndb.Key(urlsafe=my_websafe_key_string)
-        webSafeConferenceKeys = profile.conferenceKeysToAttend
+        return self._conferencesToAttendAsync(request, profile).get_result()
+
+    @ndb.tasklet
+    def _conferencesToAttendAsync(self, request, profile):
+        """Tasklet behind getConferencesToAttend."""
+        # step 2: get the user's Registrations, a page at a time if asked.
+        # ancestor queries are strongly consistent
+        query = Registration.query(ancestor=profile.key)
+
+        # step 3: fetch conferences from datastore & convert them.
+        # The get_async() calls of a batch of Registrations are sent as
+        # one batched get (do not fetch them one by one!), while the
+        # next batch of Registrations is still being fetched
+        @ndb.tasklet
+        def convert(registration):
+            conference = yield registration.conferenceKey.get_async()
+            if not conference:
+                raise ndb.Return(None)
+            form = yield self._conferenceFormAsync(conference)
+            raise ndb.Return(form)
+
+        nextPageToken = None
+        if request.pageSize is not None:
+            registrations, nextPageToken = yield self._fetchPageAsync(
+                query, request.pageSize, request.pageToken)
+            forms = yield [ convert(registration)
+                            for registration in registrations ]
+        else:
+            forms = yield query.map_async(convert)
 
-        conferenceKeys = []
-        for webSafeKey in webSafeConferenceKeys:
-            conferenceKeys.append(ndb.Key(urlsafe=webSafeKey))
+        # return set of ConferenceForm objects per Conference
+        raise ndb.Return(ConferenceForms(
+            items = [ form for form in forms if form ],
+            nextPageToken = nextPageToken
+        ))
+
+    @endpoints.method(CONF_GET_PAGE_REQUEST, ProfileForms,
+            path='conference/{webSafeKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @instrument.endpoint
+    def getConferenceAttendees(self, request):
+        """Get profiles registered for a conference (organizer only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
 
-        # step 3: fetch conferences from datastore.
-        # Use get_multi(array_of_keys) to fetch all keys at once.
-        # Do not fetch them one by one!
-        conferences = ndb.get_multi(conferenceKeys)
+        conference = self._getConference(request.webSafeKey)
+        if conference.organizerUserId != user_id:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can list attendees.')
+
+        # only keys are needed: registrations are children of the Profile
+        query = Registration.query(
+            Registration.conferenceKey == conference.key)
+        nextPageToken = None
+        if request.pageSize is not None:
+            registrationKeys, nextPageToken = self._fetchPage(
+                query, request.pageSize, request.pageToken, keys_only=True)
+        else:
+            registrationKeys = query.fetch(keys_only=True)
 
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items = [ self._copyConferenceToForm(conference, "") \
-                    for conference in conferences ]
+        profiles = ndb.get_multi([key.parent() for key in registrationKeys])
+        return ProfileForms(
+            items = [ self._copyProfileToForm(profile) \
+                      for profile in profiles if profile ],
+            nextPageToken = nextPageToken
         )
 
     @endpoints.method( message_types.VoidMessage, ConferenceForms,
                        path="filterPlayground",
                        http_method="POST",
                        name="filterPlayground" )
+    @instrument.endpoint
     def filterPlayground(self, request):
         ## Simple syntax for a filter query
         filteredConferences = Conference.query(Conference.city == "London")
@@ -410,57 +1001,120 @@ class ConferenceApi(remote.Service):
         )
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, register=True):
         """Register or unregister user for selected conference."""
         returnValue = None
-        profile = self._getProfileFromUser() # get user Profile
 
         # check if conference exists given webSafeConfKey
         # get conference; check that it exists
-        conferenceKey = request.webSafeKey
-        conference = ndb.Key(urlsafe=conferenceKey).get()
-        if not conference:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % conferenceKey)
+        conference = self._getConference(request.webSafeKey)
+        conference = seats.ensureShards(conference)
+
+        # a Registration is keyed by conference under the user's Profile
+        profile = self._getProfileFromUser() # get user Profile
+        registrationKey = ndb.Key(Registration, conference.key.urlsafe(),
+                                  parent=profile.key)
 
         # register
         if register:
-            # check if user already registered otherwise add
-            if conferenceKey in profile.conferenceKeysToAttend:
+            # a held seat was taken (and counted) when the hold was made
+            try:
+                confirmed = reservations.confirmHold(
+                    reservations.holdKey(conference.key, profile.key),
+                    registrationKey)
+            except reservations.AlreadyRegistered:
                 raise ConflictException(
                     "You have already registered for this conference")
+            if confirmed:
+                reservations.forget(conference.key, profile.key.id())
+                return BooleanMessage(data=True)
 
-            # check if seats available
-            if conference.seatsAvailable <= 0:
+            # cheap sold-out check against the cached shard total
+            if seats.seatsAvailable(conference) <= 0:
                 raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            profile.conferenceKeysToAttend.append(conferenceKey)
-            conference.seatsAvailable -= 1
-            returnValue = True
+                    "There are no seats available; hold a seat to join "
+                    "the waitlist.")
+
+            # try shards that still have seats until one hands us a seat;
+            # no candidates at all means the conference is sold out
+            entry_key = reservations.waitlistKey(conference.key,
+                                                 profile.key.id())
+            for shard_key in seats.candidateShards(conference):
+                try:
+                    returnValue = self._registerTxn(registrationKey,
+                                                    entry_key, shard_key)
+                    break
+                except seats.ShardExhausted:
+                    continue
+            else:
+                raise ConflictException(
+                    "There are no seats available; hold a seat to join "
+                    "the waitlist.")
+            seatsLeft = seats.seatsChanged(conference, -1)
+            announcement.updateNearSoldOut(conference, seatsLeft)
 
         # unregister
         else:
-            # check if user already registered
-            if conferenceKey in profile.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
-                profile.conferenceKeysToAttend.remove(conferenceKey)
-                conference.seatsAvailable += 1
-                returnValue = True
+            # the freed seat goes to the oldest waiting user first, in the
+            # same transaction, so no other registration can take it
+            returnValue, promoted = self._unregisterTxn(
+                registrationKey, reservations.waitlistHead(conference.key),
+                seats.randomShard(conference))
+            if not returnValue:
+                # unregistering is also how a waiting user withdraws
+                reservations.leaveWaitlist(conference.key, profile.key.id())
+            elif promoted:
+                reservations.forget(conference.key, promoted)
             else:
-                returnValue = False
+                seatsLeft = seats.seatsChanged(conference, 1)
+                announcement.updateNearSoldOut(conference, seatsLeft)
+                reservations.schedulePromotion(conference.key)
 
-        # write things back to the datastore & return
-        profile.put()
-        conference.put()
+        if returnValue:
+            reservations.forget(conference.key, profile.key.id())
         return BooleanMessage(data=returnValue)
 
+    @ndb.transactional(xg=True)
+    def _registerTxn(self, registrationKey, entry_key, shard_key):
+        """Create the user's Registration, taking a seat from shard; a
+        waitlist entry of the user is removed with it."""
+        # check if user already registered otherwise add (one batched
+        # get, which also tells whether the user is on the waitlist)
+        registration, entry = ndb.get_multi([registrationKey, entry_key])
+        if registration:
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        # register user, take away one seat (raises ShardExhausted if empty)
+        shard = seats.takeSeat(shard_key)
+        registration = Registration(
+            key = registrationKey,
+            conferenceKey = ndb.Key(urlsafe=registrationKey.id()))
+
+        # write things back to the datastore & return
+        ndb.put_multi([registration, shard])
+        if entry:
+            entry_key.delete()
+        return True
+
+    @ndb.transactional(xg=True)
+    def _unregisterTxn(self, registrationKey, entry_keys, shard_key):
+        """Delete the user's Registration, handing its seat to the first
+        waiting user of entry_keys (or back to shard); returns
+        (unregistered, user id the seat went to)."""
+        # check if user already registered
+        if not registrationKey.get():
+            return (False, None)
+
+        # unregister user, pass on / add back one seat
+        registrationKey.delete()
+        return (True, reservations.handOver(
+            ndb.Key(urlsafe=registrationKey.id()), entry_keys, shard_key))
+
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{webSafeKey}/register',
             http_method='POST', name='registerForConference')
+    @instrument.endpoint
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -468,50 +1122,244 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{webSafeKey}/unregister',
             http_method='POST', name='unregisterFromConference')
+    @instrument.endpoint
     def unregisterFromConference(self, request):
         """Unregister user from selected registered conference."""
         return self._conferenceRegistration(request, register = False)
 
-# - - - Announcements - - - - - - - - - - - - - - - - - - - -
-    @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache;
-        used by memcache cron job & putAnnouncement(). """
-        nearSoldOutConferences = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0
-        )).fetch(
-            projection = [Conference.name]
+    @endpoints.method(CONF_GET_REQUEST, ReservationStatusForm,
+            path='conference/{webSafeKey}/hold',
+            http_method='POST', name='holdSeat')
+    @instrument.endpoint
+    def holdSeat(self, request):
+        """Hold a seat for a few minutes (confirm it with
+        registerForConference), or join the waitlist if there is none."""
+        conference = self._getConference(request.webSafeKey)
+        conference = seats.ensureShards(conference)
+        profile = self._getProfileFromUser()
+        if ndb.Key(Registration, conference.key.urlsafe(),
+                   parent=profile.key).get():
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        # a user holding the last seat keeps it rather than queueing
+        held = reservations.extendHold(
+            reservations.holdKey(conference.key, profile.key)) is not None
+        if not held and seats.seatsAvailable(conference) > 0:
+            for shard_key in seats.candidateShards(conference):
+                try:
+                    hold, tookSeat = reservations.holdSeat(
+                        conference.key, profile.key, shard_key)
+                except seats.ShardExhausted:
+                    continue
+                except reservations.AlreadyRegistered:
+                    raise ConflictException(
+                        "You have already registered for this conference")
+                held = True
+                if tookSeat:
+                    seatsLeft = seats.seatsChanged(conference, -1)
+                    announcement.updateNearSoldOut(conference, seatsLeft)
+                break
+        if held:
+            reservations.leaveWaitlist(conference.key, profile.key.id())
+            # a 'none' status may be cached from before the hold
+            reservations.forget(conference.key, profile.key.id())
+        else:
+            reservations.joinWaitlist(conference.key, profile.key.id())
+        return self._reservationStatus(conference, profile)
+
+    @endpoints.method(CONF_GET_REQUEST, ReservationStatusForm,
+            path='conference/{webSafeKey}/reservation',
+            http_method='GET', name='getReservationStatus')
+    @instrument.endpoint
+    def getReservationStatus(self, request):
+        """Return the user's registration / hold / waitlist state; cheap
+        enough to poll instead of retrying registerForConference."""
+        return self._reservationStatus(
+            self._getConference(request.webSafeKey),
+            self._getProfileFromUser())
+
+    def _reservationStatus(self, conference, profile):
+        status = reservations.status(conference.key, profile.key)
+        holdExpires = status['holdExpires']
+        return ReservationStatusForm(
+            state = status['state'],
+            holdExpires = holdExpires and holdExpires.isoformat() + 'Z',
+            waitlistPosition = status['waitlistPosition'],
+            seatsAvailable = seats.seatsAvailable(conference)
+                             if conference.seatShards
+                             else conference.seatsAvailable,
         )
 
-        if nearSoldOutConferences:
-            # format announcement and set it in memcache.
-            announcement = """Last chance to attend! The following conferences
-                are nearly sold out:
-                {nearSoldOutConferences}""".format(
-                    nearSoldOutConferences = ", ".join(
-                        c.name for c in nearSoldOutConferences
-                    )
-                )
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    @endpoints.method(BatchRegistrationForm, RegistrationStatusForms,
+            path='conferences/registrations',
+            http_method='POST', name='batchRegistration')
+    @instrument.endpoint
+    def batchRegistration(self, request):
+        """Register or unregister many (user, conference) pairs at once.
+        Users other than the caller may only be added by the organizer."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(request.items) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d items per batch.' % MAX_BATCH_SIZE)
+        return self._batchRegistrationAsync(
+            request, getUserId(user)).get_result()
+
+    @ndb.tasklet
+    def _batchRegistrationAsync(self, request, user_id):
+        """Validate the batch with one get_multi, then process every
+        conference's items concurrently."""
+        statuses = []
+        for item in request.items:
+            statuses.append(RegistrationStatusForm(
+                userId = item.userId or user_id,
+                webSafeKey = item.webSafeKey,
+                success = False))
+
+        conferenceKeys = [ parseConferenceKey(status.webSafeKey)
+                           for status in statuses ]
+
+        # conferences and attendee profiles in a single batched get
+        lookup = list(set(key for key in conferenceKeys if key) |
+                      set(ndb.Key(Profile, s.userId) for s in statuses))
+        entities = yield ndb.get_multi_async(lookup)
+        found = dict((key, entity) for key, entity in zip(lookup, entities)
+                     if entity)
+
+        # group the valid items per conference
+        groups = {}
+        seen = set()
+        for index, (status, conferenceKey) in enumerate(
+                zip(statuses, conferenceKeys)):
+            conference = found.get(conferenceKey)
+            if not conference:
+                status.message = 'No conference found with this key.'
+            elif ndb.Key(Profile, status.userId) not in found:
+                status.message = 'No profile found for this user.'
+            elif (status.userId != user_id and
+                  conference.organizerUserId != user_id):
+                status.message = 'Only the organizer can register other users.'
+            elif (status.userId, conferenceKey) in seen:
+                status.message = 'Duplicate item in batch.'
+            else:
+                seen.add((status.userId, conferenceKey))
+                groups.setdefault(conferenceKey, []).append(index)
+
+        results = yield [ self._registerGroupAsync(
+                              seats.ensureShards(found[conferenceKey]),
+                              [ (index, statuses[index].userId)
+                                for index in indexes ],
+                              request.register )
+                          for conferenceKey, indexes in groups.items() ]
+        for result in results:
+            for index, (success, message) in result.items():
+                statuses[index].success = success
+                statuses[index].message = message
+
+        raise ndb.Return(RegistrationStatusForms(items=statuses))
+
+    @ndb.tasklet
+    def _registerGroupAsync(self, conference, entries, register):
+        """(Un)register (index, userId) entries for one conference, BATCH_CHUNK
+        per transaction; returns {index: (success, message)}."""
+        urlsafe = conference.key.urlsafe()
+        pending = [ (index, ndb.Key(Registration, urlsafe,
+                                    parent=ndb.Key(Profile, userId)))
+                    for index, userId in entries ]
+        results = {}
+
+        if register:
+            shardKeys = seats.candidateShards(conference)
+            while pending and shardKeys:
+                chunk, pending = pending[:BATCH_CHUNK], pending[BATCH_CHUNK:]
+                handled = yield self._registerChunkAsync(conference.key,
+                                                         shardKeys[0], chunk)
+                results.update(handled)
+                # whatever the shard could not seat goes to the next shard
+                leftover = [ entry for entry in chunk
+                             if entry[0] not in handled ]
+                if leftover:
+                    pending = leftover + pending
+                    shardKeys.pop(0)
+            for index, key in pending:
+                results[index] = (False, 'There are no seats available.')
+            delta = -sum(1 for success, message in results.values() if success)
         else:
-            # delete the memcache annoucements entry.
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            shard_key = seats.randomShard(conference)
+            while pending:
+                chunk, pending = pending[:BATCH_CHUNK], pending[BATCH_CHUNK:]
+                handled = yield self._unregisterChunkAsync(shard_key, chunk)
+                results.update(handled)
+            delta = sum(1 for success, message in results.values() if success)
+
+        if delta:
+            seatsLeft = seats.seatsChanged(conference, delta)
+            announcement.updateNearSoldOut(conference, seatsLeft)
+        if delta > 0:
+            # the freed seats go to the waitlist first, if any
+            reservations.schedulePromotion(conference.key)
+        reservations.forgetAll(conference.key,
+                               [ userId for index, userId in entries
+                                 if results[index][0] ])
+        raise ndb.Return(results)
+
+    @ndb.transactional_tasklet(xg=True)
+    def _registerChunkAsync(self, conferenceKey, shard_key, chunk):
+        """Create Registrations for a chunk while shard has seats; entries
+        left out of the returned {index: (success, message)} got no seat."""
+        entities = yield ndb.get_multi_async(
+            [shard_key] + [key for index, key in chunk])
+        shard, existing = entities[0], entities[1:]
+
+        results = {}
+        registrations = []
+        available = shard.seats if shard else 0
+        for (index, key), registration in zip(chunk, existing):
+            if registration:
+                results[index] = (False,
+                    'You have already registered for this conference')
+            elif available > 0:
+                registrations.append(
+                    Registration(key=key, conferenceKey=conferenceKey))
+                available -= 1
+                results[index] = (True, None)
+
+        if registrations:
+            shard.seats = available
+            yield ndb.put_multi_async([shard] + registrations)
+        raise ndb.Return(results)
+
+    @ndb.transactional_tasklet(xg=True)
+    def _unregisterChunkAsync(self, shard_key, chunk):
+        """Delete a chunk's Registrations, returning their seats to shard."""
+        entities = yield ndb.get_multi_async(
+            [shard_key] + [key for index, key in chunk])
+        shard = entities[0] or SeatShard(key=shard_key, seats=0)
+
+        results = {}
+        removed = []
+        for (index, key), registration in zip(chunk, entities[1:]):
+            if registration:
+                removed.append(key)
+                results[index] = (True, None)
+            else:
+                results[index] = (False, 'Not registered for this conference.')
 
-        return announcement
+        if removed:
+            shard.seats += len(removed)
+            yield ndb.delete_multi_async(removed) + [shard.put_async()]
+        raise ndb.Return(results)
 
+# - - - Announcements - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(message_types.VoidMessage, StringMessage,
         path='conference/announcement/get',
         http_method='GET', name='getAnnouncement')
+    @instrument.endpoint
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        # TODO 1
-        # return an existing announcement from memcache OR an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        return StringMessage(data=announcement.getAnnouncement())
 
 # registers API
 api = endpoints.api_server([ConferenceApi])
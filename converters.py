@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Precompiled entity -> ProtoRPC message converters. The field mapping
+between an ndb model and a message is worked out once, when the
+converter is built, instead of reflecting over all_fields() with
+hasattr/getattr for every entity converted.
+
+"""
+
+
+def makeConverter(model_class, message_class, transforms=None, computed=None):
+    """Return a function copying a model_class entity into a new message.
+
+    transforms -- {field name: function} applied to non-None property values
+    computed   -- {field name: function(entity)} for fields with no property
+    """
+    transforms = transforms or {}
+    computed = computed or {}
+
+    copied = []
+    derived = []
+    for field in message_class.all_fields():
+        if field.name in computed:
+            derived.append((field.name, computed[field.name]))
+        elif field.name in model_class._properties:
+            copied.append((field.name, transforms.get(field.name)))
+    # only messages with required fields can fail check_initialized()
+    check = any(field.required for field in message_class.all_fields())
+
+    def convert(entity):
+        message = message_class()
+        for name, transform in copied:
+            value = getattr(entity, name)
+            if transform is not None and value is not None:
+                value = transform(value)
+            setattr(message, name, value)
+        for name, compute in derived:
+            setattr(message, name, compute(entity))
+        if check:
+            message.check_initialized()
+        return message
+
+    return convert
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Precomputed conference counts per city, topic and month ("12 conferences
+in London"), so browse pages need not fetch and count conferences.
+
+Each count is a FacetCount entity. Every conference has a FacetTally
+child listing the counts it is currently included in.
+countConferences() compares each tally with the conference as stored and
+moves the difference into the counters, in transactions that also update
+the tallies. That makes it idempotent, so it can run from a retried task
+after any create, edit or delete. The changes of a task's conferences
+are summed per counter within each transaction, so a bulk import does
+not write "city=Default City" once per conference. rebuild() recomputes
+everything from a full scan.
+
+"""
+
+import collections
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference, FacetCount, FacetTally
+
+
+# dimension -> Conference property
+DIMENSIONS = (('city', 'city'), ('topic', 'topics'), ('month', 'month'))
+MEMCACHE_FACETS_KEY = "facetCounts"
+# short, as counter queries are eventually consistent
+FACETS_CACHE_TTL = 60
+# entity groups a cross-group transaction may touch
+MAX_ENTITY_GROUPS = 25
+# counters one conference changes per transaction at most: with its
+# tally's group this stays under MAX_ENTITY_GROUPS
+COUNTER_BATCH = 20
+# conferences per /tasks/count_facets task
+TASK_BATCH = 100
+
+
+def facetNames(conference):
+    """Return the counter names ("city=London", ...) conference counts in."""
+    names = set()
+    for dimension, prop in DIMENSIONS:
+        values = getattr(conference, prop)
+        if not isinstance(values, list):
+            values = [values]
+        names.update( u'%s=%s' % (dimension, value) for value in values
+                      if value is not None and value != '' )
+    return names
+
+
+def _tallyKey(conference_key):
+    return ndb.Key(FacetTally, 'facets', parent=conference_key)
+
+
+def scheduleCount(conference_keys):
+    """Queue count updates for conferences that were created, edited or
+    deleted; returns the (async) enqueue RPCs."""
+    tasks = []
+    for start in range(0, len(conference_keys), TASK_BATCH):
+        batch = conference_keys[start:start + TASK_BATCH]
+        tasks.append(taskqueue.Task(
+            url='/tasks/count_facets',
+            params={'webSafeKey': [ key.urlsafe() for key in batch ]}))
+    queue = taskqueue.Queue()
+    step = taskqueue.MAX_TASKS_PER_ADD
+    return [ queue.add_async(tasks[start:start + step])
+             for start in range(0, len(tasks), step) ]
+
+
+@ndb.transactional(xg=True)
+def _applyBatch(work):
+    """Apply (conference_key, wanted, names) items: every counter changes
+    once, by its summed delta, together with the tallies."""
+    conference_keys = sorted(set( key for key, wanted, names in work ))
+    names = sorted(set().union(*[ names for key, wanted, names in work ]))
+    entities = ndb.get_multi(
+        [ _tallyKey(key) for key in conference_keys ] +
+        [ ndb.Key(FacetCount, name) for name in names ])
+    tallies = dict(zip(conference_keys, entities[:len(conference_keys)]))
+    counters = dict(zip(names, entities[len(conference_keys):]))
+
+    counted = dict( (key, set(tally.facets) if tally else set())
+                    for key, tally in tallies.iteritems() )
+    deltas = collections.Counter()
+    moved = set()
+    for key, wanted, todo in work:
+        for name in todo:
+            # skip what a previous (retried) attempt already moved
+            if (name in wanted) == (name in counted[key]):
+                continue
+            if name in wanted:
+                deltas[name] += 1
+                counted[key].add(name)
+            else:
+                deltas[name] -= 1
+                counted[key].discard(name)
+            moved.add(key)
+
+    changed = []
+    doomed = []
+    for key in moved:
+        if counted[key]:
+            changed.append(FacetTally(key=_tallyKey(key),
+                                      facets=sorted(counted[key])))
+        elif tallies[key]:
+            doomed.append(tallies[key].key)
+    for name, delta in deltas.iteritems():
+        if not delta:
+            continue
+        counter = counters[name]
+        if counter is None:
+            dimension, value = name.split('=', 1)
+            counter = FacetCount(id=name, dimension=dimension, value=value,
+                                 count=0)
+        counter.count += delta
+        changed.append(counter)
+    ndb.put_multi(changed)
+    ndb.delete_multi(doomed)
+
+
+def countConferences(conference_keys):
+    """Bring the counters in line with the stored state of conference_keys
+    (a missing conference counts nowhere). Conferences are packed into as
+    few transactions as the entity group limit allows, so a counter shared
+    by many of them is written once per transaction rather than once per
+    conference. Returns True on any change."""
+    conference_keys = sorted(set(conference_keys))
+    conferences = ndb.get_multi(conference_keys)
+    tallies = ndb.get_multi([ _tallyKey(key) for key in conference_keys ])
+
+    work = []
+    for key, conference, tally in zip(conference_keys, conferences, tallies):
+        wanted = facetNames(conference) if conference else set()
+        counted = set(tally.facets) if tally else set()
+        pending = sorted(wanted ^ counted)
+        for start in range(0, len(pending), COUNTER_BATCH):
+            work.append((key, wanted, pending[start:start + COUNTER_BATCH]))
+
+    batch = []
+    groups = set()
+    for item in work:
+        key, wanted, names = item
+        # a tally shares its conference's (i.e. organizer's) entity group
+        needed = set([ key.root() ])
+        needed.update( ndb.Key(FacetCount, name) for name in names )
+        if batch and len(groups | needed) > MAX_ENTITY_GROUPS:
+            _applyBatch(batch)
+            batch = []
+            groups = set()
+        batch.append(item)
+        groups |= needed
+    if batch:
+        _applyBatch(batch)
+    if work:
+        memcache.delete(MEMCACHE_FACETS_KEY)
+    return bool(work)
+
+
+def facetCounts():
+    """Return {dimension: [(value, count), ...]}, largest counts first,
+    from memcache when possible."""
+    counts = memcache.get(MEMCACHE_FACETS_KEY)
+    if counts is None:
+        counts = dict((dimension, []) for dimension, prop in DIMENSIONS)
+        for counter in FacetCount.query(FacetCount.count > 0):
+            counts.setdefault(counter.dimension, []).append(
+                (counter.value, counter.count))
+        for values in counts.values():
+            values.sort(key=lambda item: (-item[1], item[0]))
+        memcache.set(MEMCACHE_FACETS_KEY, counts, time=FACETS_CACHE_TTL)
+    return counts
+
+
+def rebuild():
+    """Recompute every counter and tally from a full scan of conferences.
+    Count tasks are then queued for every conference scanned or tallied,
+    so any create or edit that raced the scan is reconciled afterwards.
+    Returns the conference count."""
+    counts = collections.Counter()
+    tallies = []
+    conference_keys = []
+    for conference in Conference.query().iter(batch_size=500):
+        conference_keys.append(conference.key)
+        names = facetNames(conference)
+        counts.update(names)
+        if names:
+            tallies.append(FacetTally(key=_tallyKey(conference.key),
+                                      facets=sorted(names)))
+
+    # tallies of deleted or facet-less conferences (or of conferences
+    # created after the scan passed them), and counters nothing counts
+    # in any more
+    wanted = set(tally.key for tally in tallies)
+    tallied = list(FacetTally.query().iter(keys_only=True))
+    stale = [ key for key in tallied if key not in wanted ]
+    stale.extend( key for key in FacetCount.query().iter(keys_only=True)
+                  if key.id() not in counts )
+    counters = [ FacetCount(id=name, dimension=name.split('=', 1)[0],
+                            value=name.split('=', 1)[1], count=count)
+                 for name, count in counts.iteritems() ]
+
+    ndb.put_multi(tallies + counters)
+    ndb.delete_multi(stale)
+    memcache.delete(MEMCACHE_FACETS_KEY)
+
+    # conferences the scan missed lost their tally (and their counts)
+    # above, or got one since; recount them along with the scanned ones
+    tallied.extend(FacetTally.query().iter(keys_only=True))
+    recount = set(conference_keys)
+    recount.update( key.parent() for key in tallied )
+    for rpc in scheduleCount(sorted(recount)):
+        rpc.get_result()
+    return len(conference_keys)
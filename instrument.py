@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""instrument.py
+
+Lightweight per-call instrumentation for ConferenceApi, cheap enough to
+leave on in production (unlike appstats).
+
+Every endpoint method wrapped with @endpoint records wall time, RPC
+counts and bytes per service (datastore_v3, memcache, taskqueue, ...)
+and entities read/written. RPCs are seen through an API proxy post-call
+hook, the same way appstats sees them but without keeping traces. Helpers
+wrapped with @span add their cumulative time and call count to the
+record.
+
+Each call ends with one structured (JSON) log line and one async memcache
+offset_multi that feeds the cross-instance totals served at
+/admin/endpoint_stats.
+
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+
+STATS_PREFIX = 'endpointStats:'
+# services broken out in stats()
+SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'search', 'urlfetch')
+# protobuf ByteSize() is the costliest part of a hook; turn off if needed
+RECORD_BYTES = True
+
+# datastore calls -> how to count the entities they move
+_ENTITY_COUNTS = {
+    'Get':      lambda request, response: response.entity_size(),
+    'Put':      lambda request, response: request.entity_size(),
+    'Delete':   lambda request, response: request.key_size(),
+    'RunQuery': lambda request, response: response.result_size(),
+    'Next':     lambda request, response: response.result_size(),
+}
+
+_local = threading.local()
+
+
+class Record(object):
+    """Record -- what one endpoint call did"""
+
+    __slots__ = ('endpoint', 'started', 'rpcs', 'bytes', 'entities', 'spans')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.rpcs = {}          # service -> calls
+        self.bytes = {}         # service -> request + response bytes
+        self.entities = 0
+        self.spans = {}         # name -> [calls, seconds]
+
+    def asDict(self, elapsed, failed):
+        return { 'endpoint': self.endpoint,
+                 'ms': round(elapsed * 1000, 2),
+                 'failed': failed,
+                 'rpcs': self.rpcs,
+                 'bytes': self.bytes,
+                 'entities': self.entities,
+                 'spans': dict( (name, { 'calls': calls,
+                                         'ms': round(seconds * 1000, 2) })
+                                for name, (calls, seconds)
+                                in self.spans.iteritems() ) }
+
+
+def _postCall(service, call, request, response):
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    record.rpcs[service] = record.rpcs.get(service, 0) + 1
+    try:
+        if RECORD_BYTES:
+            record.bytes[service] = record.bytes.get(service, 0) + \
+                request.ByteSize() + response.ByteSize()
+        if service == 'datastore_v3' and call in _ENTITY_COUNTS:
+            record.entities += _ENTITY_COUNTS[call](request, response)
+    except Exception:
+        # never let accounting break the call it accounts for
+        pass
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrument', _postCall)
+
+
+def span(name):
+    """Decorator adding the wrapped helper's time to the current record."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            record = getattr(_local, 'record', None)
+            if record is None:
+                return func(*args, **kwargs)
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                totals = record.spans.get(name)
+                if totals is None:
+                    totals = record.spans[name] = [0, 0.0]
+                totals[0] += 1
+                totals[1] += time.time() - started
+        return wrapper
+    return decorator
+
+
+def endpoint(func):
+    """Decorator recording one Record per call of an endpoint method."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if getattr(_local, 'record', None) is not None:
+            # an endpoint called from another one is part of its record
+            return func(self, request)
+        record = _local.record = Record(name)
+        failed = True
+        try:
+            response = func(self, request)
+            failed = False
+            return response
+        finally:
+            _local.record = None
+            _finish(record, time.time() - record.started, failed)
+    return wrapper
+
+
+def _finish(record, elapsed, failed):
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('endpoint_stats %s',
+                     json.dumps(record.asDict(elapsed, failed), sort_keys=True))
+
+    offsets = { '%s:calls' % record.endpoint: 1,
+                '%s:ms' % record.endpoint: int(elapsed * 1000),
+                '%s:entities' % record.endpoint: record.entities }
+    if failed:
+        offsets['%s:failures' % record.endpoint] = 1
+    for service, calls in record.rpcs.iteritems():
+        offsets['%s:%s.rpcs' % (record.endpoint, service)] = calls
+    for service, size in record.bytes.iteritems():
+        offsets['%s:%s.bytes' % (record.endpoint, service)] = size
+    # fire and forget, like the query cache counters
+    memcache.Client().offset_multi_async(offsets, key_prefix=STATS_PREFIX,
+                                         initial_value=0)
+
+
+def stats(endpoints):
+    """Return {endpoint: {counter: total}} across instances, with the
+    average call time, since memcache last evicted the counters."""
+    names = ['calls', 'ms', 'entities', 'failures']
+    for service in SERVICES:
+        names.extend(['%s.rpcs' % service, '%s.bytes' % service])
+
+    counters = memcache.get_multi([ '%s:%s' % (method, name)
+                                    for method in endpoints
+                                    for name in names ],
+                                  key_prefix=STATS_PREFIX)
+    result = {}
+    for method in endpoints:
+        totals = dict( (name, counters['%s:%s' % (method, name)])
+                       for name in names
+                       if '%s:%s' % (method, name) in counters )
+        if totals.get('calls'):
+            totals['avgMs'] = round(float(totals.get('ms', 0)) /
+                                    totals['calls'], 2)
+        result[method] = totals
+    return result
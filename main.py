@@ -1,22 +1,234 @@
 #!/usr/bin/env python
+import csv
+import importlib
+import json
 import webapp2
+from protorpc import protojson
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import ndb
+import announcement
+import applog
+from cache import QUERY_CACHE
+import facets
+import instrument
+from models import ConferenceForm, Profile
+import tasks
+from utils import getUserId
+
+# conference.py (Endpoints & the whole ConferenceApi) is only imported
+# by the handlers that need it, so crons & tasks start up faster
+
+# confirmation mailer limits: organizers mailed per cron run, and
+# confirmations leased (and merged into one mail) per organizer
+MAX_CONFIRMATION_MAILS = 50
+CONFIRMATION_BATCH = 100
+CONFIRMATION_LEASE_SECONDS = 60
+
+log = applog.getLogger(__name__)
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
         # TODO 1
-        # use _cacheAnnouncement() to set announcement in Memcache
-        announcement = ConferenceApi._cacheAnnouncement()
-        print announcement
+        # use cacheAnnouncement() to set announcement in Memcache
+        text = announcement.cacheAnnouncement()
+        log.info('announcement_set', announcement=text)
+
+
+class SyncSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a conference's sharded seat count onto the Conference."""
+        tasks.syncSeats(self.request.get('webSafeKey'))
+
+
+class ExpireHoldHandler(webapp2.RequestHandler):
+    def post(self):
+        """Give the seat of an expired hold back to the conference."""
+        tasks.expireHold(self.request.get('holdKey'))
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Offer a conference's free seats to its waitlist."""
+        tasks.promoteWaitlist(self.request.get('webSafeKey'))
+
+
+class PropagateDisplayNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's new displayName onto their conferences."""
+        tasks.propagateDisplayName(self.request.get('userId'))
+
+
+class CountFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move created/edited/deleted conferences into the facet counts."""
+        facets.countConferences([ ndb.Key(urlsafe=webSafeKey) for webSafeKey
+                                  in self.request.get_all('webSafeKey') ])
+
+
+class RebuildFacetCountsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recompute the facet counts from every conference."""
+        facets.rebuild()
+
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move legacy Profile registration lists into Registrations,
+        one batch per task, re-enqueueing itself until done."""
+        pageToken = tasks.migrateRegistrationBatch(
+            self.request.get('pageToken') or None)
+        if pageToken:
+            taskqueue.add(params={'pageToken': pageToken},
+                          url='/tasks/migrate_registrations')
+
+
+class ResaveConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Backfill Conference.searchKeys and the search index, one
+        batch per task, re-enqueueing itself until done."""
+        pageToken = tasks.resaveConferenceBatch(
+            self.request.get('pageToken') or None)
+        if pageToken:
+            taskqueue.add(params={'pageToken': pageToken},
+                          url='/tasks/resave_conferences')
+
+
+class DeleteRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Remove a deleted conference's registrations and waitlist, one
+        batch per task, re-enqueueing itself until done."""
+        webSafeKey = self.request.get('webSafeKey')
+        if tasks.deleteRegistrationBatch(webSafeKey):
+            taskqueue.add(params={'webSafeKey': webSafeKey},
+                          url='/tasks/delete_registrations')
+
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send pending creation confirmations, one mail per organizer."""
+        queue = taskqueue.Queue(tasks.CONFIRMATION_QUEUE)
+        for sent in range(MAX_CONFIRMATION_MAILS):
+            # leases tasks sharing the oldest task's tag, i.e. organizer
+            leased = queue.lease_tasks_by_tag(CONFIRMATION_LEASE_SECONDS,
+                                              CONFIRMATION_BATCH)
+            if not leased:
+                break
+
+            conferenceKeys = list(set(ndb.Key(urlsafe=task.payload)
+                                      for task in leased))
+            conferences = [ conference for conference in
+                            ndb.get_multi(conferenceKeys) if conference ]
+            if conferences:
+                mail.send_mail(
+                    'noreply@{id}.appspotmail.com'.format(
+                        id = app_identity.get_application_id()
+                    ),                                          # from
+                    leased[0].tag,                              # to
+                    'You created a new Conference!',            # subject
+                    "Hi, you have created the following "       # body
+                    "conference(s):\r\n\r\n{conferenceInfo}".format(
+                        conferenceInfo = "\r\n".join(
+                            "{name} ({city}, {startDate})".format(
+                                name = conference.name,
+                                city = conference.city,
+                                startDate = conference.startDate or 'TBD'
+                            ) for conference in conferences
+                        )
+                    )
+                )
+            # only once mailed; a failure leaves them to be leased again
+            queue.delete_tasks(leased)
+
+
+def _csvRecords(lines):
+    """Yield (ConferenceForm, error) per CSV row; topics are ';'-separated."""
+    for row in csv.DictReader(lines):
+        try:
+            # the csv module yields UTF-8 bytes; empty cells mean "not set"
+            cells = dict( (name, value.decode('utf-8').strip() or None)
+                          for name, value in row.items()
+                          if name and value is not None )
+            yield (ConferenceForm(
+                name = cells.get('name'),
+                description = cells.get('description'),
+                city = cells.get('city'),
+                topics = [ topic.strip() for topic in
+                           (cells.get('topics') or '').split(';') if topic.strip() ],
+                startDate = cells.get('startDate'),
+                endDate = cells.get('endDate'),
+                maxAttendees = int(cells['maxAttendees'])
+                               if cells.get('maxAttendees') else None,
+            ), None)
+        except ValueError as e:
+            # bad encoding or a non-numeric maxAttendees
+            yield (None, 'Invalid record: %s' % e)
+
+
+def _jsonLinesRecords(lines):
+    """Yield (ConferenceForm, error) per non-blank JSON line."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield (protojson.decode_message(ConferenceForm, line), None)
+        except Exception as e:
+            # malformed JSON and field validation errors alike
+            yield (None, 'Invalid record: %s' % e)
+
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Stream a CSV (text/csv) or JSON lines upload of conferences into
+        the datastore, organized by the signed-in (admin) user."""
+        user = users.get_current_user()
+        profile = ndb.Key(Profile, getUserId(user)).get()
+        if not profile:
+            self.abort(400, 'Create a profile before importing conferences.')
+
+        # read the body line by line rather than all at once
+        lines = self.request.body_file
+        if self.request.content_type == 'text/csv':
+            records = _csvRecords(lines)
+        else:
+            records = _jsonLinesRecords(lines)
+
+        from conference import ConferenceApi
+        result = ConferenceApi._importConferences(records, user, profile)
+        self.response.content_type = 'application/json'
+        self.response.write(protojson.encode_message(result))
+
+
+class EndpointStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return per-endpoint call, time, RPC and entity totals as JSON."""
+        from conference import ConferenceApi
+        stats = instrument.stats(sorted(ConferenceApi.all_remote_methods()))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and prime the hot caches before the instance
+        takes user traffic (App Engine warmup request)."""
+        # imported for their side effect: the modules stay loaded for the
+        # /_ah/spi and /public handlers this instance will serve
+        importlib.import_module('conference')
+        importlib.import_module('public')
+        QUERY_CACHE.generation()
+        announcement.getAnnouncement()
+        facets.facetCounts()
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation (legacy push tasks
+        queued before confirmations were batched)."""
         mail.send_mail(
             'noreply@{id}.appspotmail.com'.format(
                 id = app_identity.get_application_id()
@@ -41,6 +253,19 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
 app = webapp2.WSGIApplication([
         ('/crons/set_announcement', SetAnnouncementHandler),
+        ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
+        ('/crons/rebuild_facet_counts', RebuildFacetCountsHandler),
+        ('/admin/import_conferences', ImportConferencesHandler),
+        ('/admin/endpoint_stats', EndpointStatsHandler),
         ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+        ('/tasks/sync_seats', SyncSeatsHandler),
+        ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+        ('/tasks/resave_conferences', ResaveConferencesHandler),
+        ('/tasks/count_facets', CountFacetsHandler),
+        ('/tasks/expire_hold', ExpireHoldHandler),
+        ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+        ('/tasks/propagate_display_name', PropagateDisplayNameHandler),
+        ('/tasks/delete_registrations', DeleteRegistrationsHandler),
+        ('/_ah/warmup', WarmupHandler),
     ], debug = True
 )
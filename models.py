@@ -12,8 +12,6 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-import httplib
-import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
@@ -25,8 +23,46 @@ class Profile(ndb.Model):
     displayName  = ndb.StringProperty()
     mainEmail    = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy: registrations are now Registration entities; entries left
+    # here are moved over by tasks.migrateRegistrations()
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
 
+    # Profiles are read on every authenticated call. NDB caches them in
+    # memcache keyed by the Profile key (i.e. the user id), writes through
+    # on put() and invalidates on delete; keep them there for an hour.
+    _use_memcache = True
+    _memcache_timeout = 3600
+
+
+class UserEmail(ndb.Model):
+    """UserEmail -- maps an email (key name) to its Profile's user id;
+    lets getUserId(id_type="custom") resolve users with one key get"""
+    userId = ndb.StringProperty(indexed=False)
+
+    _use_memcache = True
+    _memcache_timeout = 3600
+
+
+class Registration(ndb.Model):
+    """Registration -- a Profile (parent) attending a Conference;
+    keyed by the conference's webSafeKey under the Profile"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    created       = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class SeatHold(ndb.Model):
+    """SeatHold -- a seat kept for a Profile (parent) until it expires;
+    keyed by the conference's webSafeKey like Registration"""
+    conferenceKey = ndb.KeyProperty(kind='Conference', indexed=False)
+    expires       = ndb.DateTimeProperty(indexed=False)
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat, id "<webSafeKey>|<userId>" """
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    userId        = ndb.StringProperty(indexed=False)
+    created       = ndb.DateTimeProperty(auto_now_add=True)
+
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -43,6 +79,12 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 4)
 
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple ProfileForm outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     # Because we don't want users to put in arbitrary values,
@@ -65,11 +107,39 @@ class TeeShirtSize(messages.Enum):
 
 
 # Conference-related Classes - - - - - - - - - - -
+# fields whose equality combinations are precomputed into searchKeys
+SEARCH_KEY_FIELDS = ('city', 'month', 'topics')
+
+
+def searchKey(pairs):
+    """Return the searchKeys value for (field, value) equality pairs."""
+    return '|'.join('%s=%s' % pair for pair in sorted(pairs))
+
+
+def _searchKeys(conference):
+    # every combination of two or more SEARCH_KEY_FIELDS, one value each
+    values = []
+    for field in SEARCH_KEY_FIELDS:
+        value = getattr(conference, field)
+        if not isinstance(value, list):
+            value = [value] if value is not None else []
+        values.append([ (field, v) for v in value ])
+    combos = [[]]
+    for fieldValues in values:
+        combos = combos + [ combo + [pair] for combo in combos
+                                           for pair in fieldValues ]
+    return sorted(set( searchKey(combo) for combo in combos
+                       if len(combo) >= 2 ))
+
+
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    # copy of the organizer Profile's displayName, kept in sync by a task;
+    # indexed for the queryConferenceSummaries projection
+    organizerDisplayName = ndb.StringProperty()
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -77,6 +147,33 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
     endDate         = ndb.DateProperty()
+    # number of SeatShards holding the live seat count; 0 = not sharded yet
+    seatShards      = ndb.IntegerProperty(default=0, indexed=False)
+    # e.g. "city=London|month=6"; lets planner.py answer several
+    # equality filters with one indexed equality
+    searchKeys      = ndb.ComputedProperty(_searchKeys, repeated=True)
+    # bumped by every put; the ETag of the public detail view
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+
+class FacetCount(ndb.Model):
+    """FacetCount -- conferences per city/topic/month, id "city=London" """
+    dimension = ndb.StringProperty(indexed=False)
+    value     = ndb.StringProperty(indexed=False)
+    count     = ndb.IntegerProperty(default=0)
+
+
+class FacetTally(ndb.Model):
+    """FacetTally -- FacetCount names a Conference (parent) is counted in"""
+    facets = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    seats = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -95,9 +192,72 @@ class ConferenceForm(messages.Message):
     organizerDisplayName = messages.StringField(12)
 
 
+class QueryPlanForm(messages.Message):
+    """QueryPlanForm -- outbound queryConferences plan (explain mode)"""
+    strategy      = messages.StringField(1)
+    index         = messages.StringField(2)
+    postFilters   = messages.StringField(3, repeated=True)
+    estimatedCost = messages.IntegerField(4)
+
+
+class FacetValueForm(messages.Message):
+    """FacetValueForm -- one facet value and how many matches have it"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class FacetForm(messages.Message):
+    """FacetForm -- outbound counts for one facet (city, topic, month)"""
+    field  = messages.StringField(1)
+    values = messages.MessageField(FacetValueForm, 2, repeated=True)
+
+
+class FacetForms(messages.Message):
+    """FacetForms -- outbound precomputed counts for every facet"""
+    items = messages.MessageField(FacetForm, 1, repeated=True)
+
+
 class ConferenceForms(messages.Message):
     """multiple ConferenceForm outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    # opaque cursor for the next page; only set when more results exist
+    nextPageToken = messages.StringField(2)
+    # only set for explain requests
+    plan = messages.MessageField(QueryPlanForm, 3)
+    # only set by searchConferences
+    facets = messages.MessageField(FacetForm, 4, repeated=True)
+
+
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- compact outbound message for listings"""
+    name            = messages.StringField(1)
+    city            = messages.StringField(2)
+    startDate       = messages.StringField(3)
+    maxAttendees    = messages.IntegerField(4)
+    seatsAvailable  = messages.IntegerField(5)
+    webSafeKey      = messages.StringField(6)
+    endDate         = messages.StringField(7)
+    organizerDisplayName = messages.StringField(8)
+
+
+class ConferenceSummaryForms(messages.Message):
+    """multiple ConferenceSummaryForm outbound form message"""
+    items = messages.MessageField(ConferenceSummaryForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class ImportErrorForm(messages.Message):
+    """ImportErrorForm -- why one record of an import was rejected"""
+    index   = messages.IntegerField(1)
+    message = messages.StringField(2)
+
+
+class ConferenceImportResultForm(messages.Message):
+    """ConferenceImportResultForm -- outbound bulk import summary"""
+    imported         = messages.IntegerField(1)
+    errors           = messages.MessageField(ImportErrorForm, 2, repeated=True)
+    seconds          = messages.FloatField(3)
+    recordsPerSecond = messages.FloatField(4)
 
 
 class ConferenceQueryForm(messages.Message):
@@ -110,6 +270,29 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField( ConferenceQueryForm, 1, repeated=True )
+    # optional paging: leave pageSize empty to get every match at once
+    pageSize  = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    # return the query plan instead of running the query
+    explain   = messages.BooleanField(4)
+
+
+class ConferenceSearchForm(messages.Message):
+    """ConferenceSearchForm -- inbound full-text search with refinements"""
+    query     = messages.StringField(1)
+    city      = messages.StringField(2)
+    topic     = messages.StringField(3)
+    month     = messages.IntegerField(4)
+    pageSize  = messages.IntegerField(5)
+    pageToken = messages.StringField(6)
+
+
+class QueryCacheStatsForm(messages.Message):
+    """QueryCacheStatsForm -- outbound queryConferences cache counters"""
+    localHits    = messages.IntegerField(1)
+    memcacheHits = messages.IntegerField(2)
+    misses       = messages.IntegerField(3)
+    generation   = messages.IntegerField(4)
 
 
 # needed for conference registration
@@ -117,11 +300,40 @@ class BooleanMessage(messages.Message):
     """BooleanMessage - outbound Boolean value message"""
     data = messages.BooleanField(1)
 
-class ConflictException(endpoints.ServiceException):
-    """ConflictException - exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
+class RegistrationItemForm(messages.Message):
+    """RegistrationItemForm -- one (user, conference) pair of a batch"""
+    userId     = messages.StringField(1)
+    webSafeKey = messages.StringField(2)
+
+class BatchRegistrationForm(messages.Message):
+    """BatchRegistrationForm -- inbound batch (un)registration message"""
+    items    = messages.MessageField(RegistrationItemForm, 1, repeated=True)
+    register = messages.BooleanField(2, default=True)
+
+class RegistrationStatusForm(messages.Message):
+    """RegistrationStatusForm -- outcome of one batch item"""
+    userId     = messages.StringField(1)
+    webSafeKey = messages.StringField(2)
+    success    = messages.BooleanField(3)
+    message    = messages.StringField(4)
+
+class RegistrationStatusForms(messages.Message):
+    """RegistrationStatusForms -- per-item outcomes, in request order"""
+    items = messages.MessageField(RegistrationStatusForm, 1, repeated=True)
+
+class ReservationStatusForm(messages.Message):
+    """ReservationStatusForm -- outbound seat hold / waitlist status"""
+    state            = messages.StringField(1)
+    holdExpires      = messages.StringField(2)
+    waitlistPosition = messages.IntegerField(3)
+    seatsAvailable   = messages.IntegerField(4)
 
 # needed for memcache announcements
+class Announcement(ndb.Model):
+    """Announcement -- singleton set of nearly sold out conferences,
+    maintained as registrations cross the threshold"""
+    conferences = ndb.JsonProperty()    # webSafeKey -> conference name
+
 class StringMessage(messages.Message):
     """StringMessage - outbound (single) string message"""
     data = messages.StringField(1, required=True)
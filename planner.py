@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Query planning for queryConferences. Rather than chaining every filter
+onto one query (which needs a composite index per filter combination),
+plan() costs the strategies the datastore can actually serve and picks
+the cheapest:
+
+    composite   -- every filter in one query; only for the filter shapes
+                   covered by a composite index in index.yaml
+    searchKey   -- two or more equality filters on city/month/topics
+                   answered by one equality on Conference.searchKeys
+    zigzag      -- equality filters only, merge-joined over the built-in
+                   single-property indexes, sorted by name in memory
+                   (not usable when paging)
+    narrowest   -- the most selective filter that has an index drives
+                   the query; the remaining filters are applied in memory
+
+Costs are estimated entity reads, from CARDINALITY_HINTS.
+
+It also parses the user supplied filters (formatFilters) and derives
+the query cache key and scope from them (cacheKey). public.py uses these
+to answer conditional listing requests without importing conference.py.
+Writers bump the scopes changeScopes() names for what they changed.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from cache import GenerationalCache
+from models import Conference, searchKey, SEARCH_KEY_FIELDS
+
+
+OPERATORS = { 'EQ':   '=',
+              'GT':   '>',
+              'GTEQ': '>=',
+              'LT':   '<',
+              'LTEQ': '<=',
+              'NE':   '!=' }
+
+FIELDS =    { 'CITY': 'city',
+              'TOPIC': 'topics',
+              'MONTH': 'month',
+              'MAX_ATTENDEES': 'maxAttendees', }
+
+# query cache views (see conference.py): whole ConferenceForms, or the
+# summaries listings show
+CACHE_VIEWS = ('full', 'summary')
+
+# filter shapes served by index.yaml, as (sorted equality fields, sort
+# field); keep in sync with index.yaml. Each (field, name) index serves
+# both "field = x ORDER BY name" and "field < x ORDER BY field, name".
+INDEXED_SHAPES = frozenset([
+    ((), None),                                 # built-in index on name
+    (('city', 'month', 'topics'), None),
+    (('city',), None), ((), 'city'),
+    (('maxAttendees',), None), ((), 'maxAttendees'),
+    (('month',), None), ((), 'month'),
+    (('topics',), None), ((), 'topics'),
+])
+
+# the subset of INDEXED_SHAPES that also has an index covering the
+# queryConferenceSummaries projection (see index.yaml); other shapes
+# must read whole entities
+PROJECTED_SHAPES = frozenset([
+    ((), None),
+    (('city',), None),
+])
+
+# rough number of distinct values per field and conferences overall,
+# used to estimate how many entities each strategy reads
+CARDINALITY_HINTS = { 'city': 50,
+                      'topics': 20,
+                      'month': 12,
+                      'maxAttendees': 10, }
+CATALOG_SIZE_HINT = 10000
+# an inequality is assumed to keep a third of the rows
+INEQUALITY_SELECTIVITY = 1 / 3.0
+
+PYTHON_OPERATORS = { '=':  operator.eq,
+                     '!=': operator.ne,
+                     '<':  operator.lt,
+                     '<=': operator.le,
+                     '>':  operator.gt,
+                     '>=': operator.ge, }
+
+
+class FilterError(ValueError):
+    """FilterError -- user supplied filters that cannot be queried"""
+    pass
+
+
+def formatFilters(filters):
+    """Parse, check validity and format user supplied filters; returns
+    (inequality field or None, filters). Raises FilterError."""
+    formatted_filters = []
+    inequality_field = None
+
+    for f in filters:
+        filtre = {field.name: getattr(f, field.name) for field in f.all_fields()}
+
+        try:
+            filtre["field"] = FIELDS[filtre["field"]]
+            filtre["operator"] = OPERATORS[filtre["operator"]]
+        except KeyError:
+            raise FilterError("Filter contains invalid field or operator.")
+
+        if filtre["field"] in ["month", "maxAttendees"]:
+            try:
+                filtre["value"] = int(filtre["value"])
+            except (TypeError, ValueError):
+                raise FilterError("Filter value must be a number.")
+
+        # Every operation except "=" is an inequality
+        if filtre["operator"] != "=":
+            # check if inequality operation has been used in previous filters
+            # disallow the filter if inequality was performed on a different field before
+            # track the field on which the inequality operation is performed
+            if inequality_field and inequality_field != filtre["field"]:
+                raise FilterError("Inequality filter is allowed on only one field.")
+            else:
+                inequality_field = filtre["field"]
+
+        formatted_filters.append(filtre)
+    return (inequality_field, formatted_filters)
+
+
+def _cacheScope(view, city):
+    # digested, as memcache keys must be short byte strings
+    return GenerationalCache.makeKey(view, city and unicode(city))
+
+
+def cacheKey(request, view='full'):
+    """Return the query cache key of a ConferenceQueryForms request,
+    ignoring filter order, and its cache scope: the view and, with an
+    equality filter on city, that city. Raises FilterError."""
+    inequality_filter, filters = formatFilters(request.filters)
+    canonical = sorted( (f["field"], f["operator"], f["value"])
+                        for f in filters )
+    cities = sorted( f["value"] for f in filters
+                     if f["field"] == "city" and f["operator"] == "=" )
+    key = GenerationalCache.makeKey( view,
+                                     tuple(canonical),
+                                     request.pageSize,
+                                     request.pageToken )
+    return (key, _cacheScope(view, cities[0] if cities else None))
+
+
+def changeScopes(cities, views=CACHE_VIEWS):
+    """Return the cache scopes to bump after conferences in cities (both
+    old and new ones) changed in a way views show: each city's scope, and
+    that of the queries without a city equality filter."""
+    cities = set(cities)
+    cities.add(None)
+    return [ _cacheScope(view, city) for view in views for city in cities ]
+
+
+class QueryPlan(object):
+    """QueryPlan -- a datastore query plus the filters left for memory"""
+
+    def __init__(self, strategy, query, postFilters, cost, index,
+                 sortInMemory=None, projectable=False):
+        self.strategy = strategy
+        self.query = query
+        self.postFilters = postFilters
+        self.cost = cost
+        self.index = index
+        # key function when results must be sorted after fetching
+        self.sortInMemory = sortInMemory
+        # True if index.yaml can serve the summary projection of query
+        self.projectable = projectable
+
+    def matches(self, conference):
+        """Apply the in-memory filters (any value of a repeated property
+        may match, as in the datastore)."""
+        for filtre in self.postFilters:
+            test = PYTHON_OPERATORS[filtre["operator"]]
+            values = getattr(conference, filtre["field"])
+            if not isinstance(values, list):
+                values = [values]
+            if not any(value is not None and test(value, filtre["value"])
+                       for value in values):
+                return False
+        return True
+
+    def describe(self):
+        """Return the post-filters as human readable strings."""
+        return [ '%s %s %r' % (f["field"], f["operator"], f["value"])
+                 for f in self.postFilters ]
+
+
+def _selectivity(filtre):
+    if filtre["operator"] == '=':
+        return 1.0 / CARDINALITY_HINTS.get(filtre["field"], 10)
+    if filtre["operator"] == '!=':
+        return 1.0
+    return INEQUALITY_SELECTIVITY
+
+
+def _estimate(filters):
+    rows = float(CATALOG_SIZE_HINT)
+    for filtre in filters:
+        rows *= _selectivity(filtre)
+    return max(int(round(rows)), 1)
+
+
+def _query(filters, orderField=None, byName=True):
+    """Build a Conference query with filters, ordered like queryConferences
+    always has been: on the inequality field (if any) first, then name."""
+    query = Conference.query()
+    if orderField:
+        query = query.order(ndb.GenericProperty(orderField))
+    if byName:
+        query = query.order(Conference.name)
+    for filtre in filters:
+        query = query.filter(ndb.query.FilterNode( filtre["field"],
+                                                   filtre["operator"],
+                                                   filtre["value"] ))
+    return query
+
+
+def _byName(conference):
+    return conference.name
+
+
+def _byField(field):
+    def key(conference):
+        return (getattr(conference, field), conference.name)
+    return key
+
+
+def plan(inequality_field, filters, paged):
+    """Return the cheapest QueryPlan for already formatted filters."""
+    equalities = [ f for f in filters if f["operator"] == '=' ]
+    inequalities = [ f for f in filters if f["operator"] != '=' ]
+    eqFields = tuple(sorted(f["field"] for f in equalities))
+    candidates = []
+
+    # everything in one query, if index.yaml has the index for it
+    if (eqFields, inequality_field) in INDEXED_SHAPES:
+        candidates.append(QueryPlan(
+            'composite', _query(filters, inequality_field), [],
+            _estimate(filters),
+            ', '.join(eqFields + ((inequality_field,) if inequality_field else ())
+                      + ('name',)),
+            projectable=(eqFields, inequality_field) in PROJECTED_SHAPES))
+
+    # several equalities folded into one searchKeys value
+    if (not inequalities and len(equalities) >= 2 and
+            set(eqFields) <= set(SEARCH_KEY_FIELDS) and
+            len(set(eqFields)) == len(eqFields)):
+        key = searchKey((f["field"], f["value"]) for f in equalities)
+        candidates.append(QueryPlan(
+            'searchKey', _query([{ "field": "searchKeys",
+                                   "operator": '=',
+                                   "value": key }]), [],
+            _estimate(filters), 'searchKeys, name'))
+
+    # zigzag merge join: cost grows with every index it has to walk
+    if not inequalities and len(equalities) >= 2 and not paged:
+        candidates.append(QueryPlan(
+            'zigzag', _query(filters, byName=False), [],
+            _estimate(filters) * len(equalities),
+            ' + '.join(eqFields), sortInMemory=_byName))
+
+    # one indexed filter drives, the others are checked in memory
+    drivers = [ (f, (f["field"],), None) for f in equalities ]
+    if inequality_field:
+        drivers.append((None, (), inequality_field))
+    for driver, driverFields, orderField in drivers:
+        if (driverFields, orderField) not in INDEXED_SHAPES:
+            continue
+        if driver is None:
+            driving = inequalities
+        else:
+            driving = [driver]
+        # results must come back ordered by the inequality field; an
+        # equality-driven query can only do that by sorting in memory,
+        # which rules it out for paged requests
+        sortInMemory = None
+        if inequality_field and driver is not None:
+            if paged:
+                continue
+            sortInMemory = _byField(inequality_field)
+        postFilters = [ f for f in filters if f not in driving ]
+        candidates.append(QueryPlan(
+            'narrowest', _query(driving, orderField), postFilters,
+            _estimate(driving),
+            ', '.join(driverFields + ((orderField,) if orderField else ())
+                      + ('name',)),
+            sortInMemory))
+
+    # last resort: walk everything by name
+    # (any inequality field has its own index, so this is never needed to
+    # keep the inequality ordering)
+    candidates.append(QueryPlan(
+        'narrowest', _query([]), list(filters), CATALOG_SIZE_HINT, 'name'))
+
+    # cheapest wins; ties go to the earlier (simpler) strategy
+    return min(candidates, key=lambda candidate: candidate.cost)
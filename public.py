@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""public.py
+
+Anonymous, cacheable read API. It serves the same JSON as the Endpoints
+API, but without the auth stack, and with headers that let browsers and
+the App Engine edge cache keep the responses. Listings are
+queryConferenceSummaries' compact summaries:
+
+    GET /public/conferences[?filter=CITY,EQ,London&pageSize=&pageToken=]
+    GET /public/conferences/<webSafeKey>
+    GET /public/announcement
+
+Every response has a strong ETag and a short public Cache-Control. A
+request whose If-None-Match still matches gets a 304 without its body
+being built, or conference.py (Endpoints and the ConferenceApi) even
+being imported. A conference's ETag comes from Conference.version, which
+every put bumps. A listing's comes from the query cache generation of
+its scope (see planner.cacheKey). The announcement's is a digest of its
+text.
+
+"""
+
+import hashlib
+import json
+
+import webapp2
+from protorpc import protojson
+
+import announcement
+from cache import QUERY_CACHE
+from models import ConferenceQueryForm, ConferenceQueryForms
+import planner
+from utils import parseConferenceKey
+
+
+LIST_MAX_AGE = 30
+# listings are paged even when the client asks for no pageSize, so a
+# single anonymous request never reads the whole catalog
+LIST_PAGE_SIZE = 20
+LIST_MAX_PAGE_SIZE = 100
+DETAIL_MAX_AGE = 60
+ANNOUNCEMENT_MAX_AGE = 60
+
+
+def _matches(ifNoneMatch, etag):
+    """Return True if an If-None-Match header value matches etag."""
+    if not ifNoneMatch:
+        return False
+    tags = [ tag.strip() for tag in ifNoneMatch.split(',') ]
+    return '*' in tags or etag in tags
+
+
+class PublicHandler(webapp2.RequestHandler):
+    """PublicHandler -- conditional, cacheable JSON responses"""
+
+    def respond(self, etag, maxAge, render):
+        """Send render()'s JSON body, or a 304 if the client has it."""
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % maxAge
+        if _matches(self.request.headers.get('If-None-Match'), etag):
+            self.response.status_int = 304
+            return
+        self.response.content_type = 'application/json'
+        self.response.write(render())
+
+
+class ConferenceListHandler(PublicHandler):
+    def get(self):
+        """List conference summaries; filters as FIELD,OPERATOR,value
+        triples."""
+        filters = []
+        for filtre in self.request.get_all('filter'):
+            parts = filtre.split(',', 2)
+            if len(parts) != 3:
+                self.abort(400, 'filter must be FIELD,OPERATOR,value')
+            filters.append(ConferenceQueryForm(field=parts[0],
+                                               operator=parts[1],
+                                               value=parts[2]))
+        try:
+            pageSize = int(self.request.get('pageSize') or LIST_PAGE_SIZE)
+        except ValueError:
+            self.abort(400, 'pageSize must be a number')
+        if pageSize <= 0:
+            self.abort(400, 'pageSize must be positive')
+        pageSize = min(pageSize, LIST_MAX_PAGE_SIZE)
+        request = ConferenceQueryForms(
+            filters=filters, pageSize=pageSize,
+            pageToken=self.request.get('pageToken') or None)
+
+        # listings change whenever their scope's generation moves on;
+        # bodies are shared with queryConferenceSummaries' cache entries
+        try:
+            cache_key, scope = planner.cacheKey(request, 'summary')
+        except planner.FilterError as e:
+            self.abort(400, str(e))
+        etag = '"list-%s-%s"' % (QUERY_CACHE.version(scope), cache_key)
+
+        def render():
+            body = QUERY_CACHE.get(cache_key, scope)
+            if body is None:
+                # the API is only loaded to run a query
+                import endpoints
+                from conference import ConferenceApi
+                try:
+                    forms = ConferenceApi()._queryConferenceSummaries(request)
+                except endpoints.BadRequestException as e:
+                    self.abort(400, str(e))
+                body = protojson.encode_message(forms)
+                QUERY_CACHE.set(cache_key, body, scope)
+            return body
+
+        self.respond(etag, LIST_MAX_AGE, render)
+
+
+class ConferenceDetailHandler(PublicHandler):
+    def get(self, webSafeKey):
+        """Return one conference."""
+        conference_key = parseConferenceKey(webSafeKey)
+        conference = conference_key and conference_key.get()
+        if not conference:
+            self.abort(404, 'No conference found with key: %s' % webSafeKey)
+
+        etag = '"%s-%d"' % (webSafeKey, conference.version)
+
+        def render():
+            # the API's converters are only loaded to build a body
+            from conference import ConferenceApi
+            return protojson.encode_message(
+                ConferenceApi()._copyConferencesToForms([conference])[0])
+
+        self.respond(etag, DETAIL_MAX_AGE, render)
+
+
+class AnnouncementHandler(PublicHandler):
+    def get(self):
+        """Return the near-sold-out announcement."""
+        body = json.dumps({'data': announcement.getAnnouncement()})
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.respond(etag, ANNOUNCEMENT_MAX_AGE, lambda: body)
+
+
+app = webapp2.WSGIApplication([
+        ('/public/conferences', ConferenceListHandler),
+        ('/public/conferences/([^/]+)', ConferenceDetailHandler),
+        ('/public/announcement', AnnouncementHandler),
+    ], debug = True
+)
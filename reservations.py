@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""reservations.py
+
+Short-lived seat holds and a FIFO waitlist per conference.
+
+A SeatHold takes a seat from the conference's shards (see seats.py) and
+keeps it for its user until it is confirmed by registerForConference or
+expires. As long as a SeatHold entity exists, its seat is held. An
+expiry task returns the seat and deletes the hold.
+
+When there is no seat to hold, the user joins the conference's
+waitlist instead. Each WaitlistEntry is its own entity group, so a rush
+of joiners does not contend. A seat freed by an unregistration or an
+expired hold is handed to the oldest waiting user, as a hold, in the
+same transaction that frees it (handOver), so no concurrent
+registration can take it first. Seats freed any other way (or that
+none of the head entries could take) go back to the shards, and a
+/tasks/promote_waitlist task turns the oldest entries into holds.
+
+Clients poll status(), which is cached in memcache per user and
+conference, instead of retrying registrations.
+
+"""
+
+import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Profile, Registration
+from models import SeatHold, WaitlistEntry
+import seats
+
+
+HOLD_SECONDS = 120
+# promoted users were not waiting on the page; give them longer
+PROMOTED_HOLD_SECONDS = 600
+# waitlist entries promoted per task at most
+PROMOTE_BATCH = 20
+# oldest entries a freed seat is offered to within its transaction; each
+# costs two of the 25 entity groups a cross-group transaction may touch
+HANDOVER_CANDIDATES = 5
+MEMCACHE_STATUS_KEY = "reservation:%s:%s"
+STATUS_CACHE_TTL = 30
+
+
+class AlreadyRegistered(Exception):
+    """The user has a Registration already, so needs no seat."""
+
+
+def holdKey(conference_key, profile_key):
+    """Return the key of a user's hold on a conference (one at most)."""
+    return ndb.Key(SeatHold, conference_key.urlsafe(), parent=profile_key)
+
+
+def waitlistKey(conference_key, user_id):
+    return ndb.Key(WaitlistEntry, '%s|%s' % (conference_key.urlsafe(), user_id))
+
+
+def _registrationKey(conference_key, profile_key):
+    return ndb.Key(Registration, conference_key.urlsafe(), parent=profile_key)
+
+
+def forget(conference_key, user_id):
+    """Drop the cached status after a user's reservation changed."""
+    memcache.delete(MEMCACHE_STATUS_KEY % (conference_key.urlsafe(), user_id))
+
+
+def forgetAll(conference_key, user_ids):
+    """forget() for many users at once (one memcache call)."""
+    urlsafe = conference_key.urlsafe()
+    memcache.delete_multi([ MEMCACHE_STATUS_KEY % (urlsafe, user_id)
+                            for user_id in user_ids ])
+
+
+def _scheduleExpiry(hold):
+    # only runs if the enclosing transaction commits
+    taskqueue.add(params={'holdKey': hold.key.urlsafe()},
+                  url='/tasks/expire_hold',
+                  eta=hold.expires + datetime.timedelta(seconds=1),
+                  transactional=True)
+
+
+@ndb.transactional(xg=True)
+def holdSeat(conference_key, profile_key, shard_key, seconds=HOLD_SECONDS):
+    """Hold a seat from shard for seconds; returns (hold, took a seat).
+    An existing hold is extended instead (its seat is still held). Raises
+    seats.ShardExhausted if the shard is empty and AlreadyRegistered if
+    the user needs no seat."""
+    if _registrationKey(conference_key, profile_key).get():
+        raise AlreadyRegistered()
+
+    hold = extendHold(holdKey(conference_key, profile_key), seconds)
+    if hold:
+        return (hold, False)
+
+    shard = seats.takeSeat(shard_key)
+    hold = SeatHold(key=holdKey(conference_key, profile_key),
+                    conferenceKey=conference_key,
+                    expires=datetime.datetime.utcnow() +
+                            datetime.timedelta(seconds=seconds))
+    ndb.put_multi([hold, shard])
+    _scheduleExpiry(hold)
+    return (hold, True)
+
+
+@ndb.transactional
+def extendHold(hold_key, seconds=HOLD_SECONDS):
+    """Keep an existing hold for at least seconds more; returns the hold,
+    or None if there is none. Needs no free seat, as its own is kept."""
+    hold = hold_key.get()
+    if not hold:
+        return None
+    hold.expires = max(hold.expires, datetime.datetime.utcnow() +
+                                     datetime.timedelta(seconds=seconds))
+    hold.put()
+    _scheduleExpiry(hold)
+    return hold
+
+
+@ndb.transactional
+def confirmHold(hold_key, registration_key):
+    """Turn a hold into a Registration; False if there is no hold.
+    The seat was taken when the hold was made."""
+    hold = hold_key.get()
+    if not hold:
+        return False
+    if registration_key.get():
+        raise AlreadyRegistered()
+    hold_key.delete()
+    Registration(key=registration_key,
+                 conferenceKey=hold.conferenceKey).put()
+    return True
+
+
+def waitlistHead(conference_key, limit=HANDOVER_CANDIDATES):
+    """Return the keys of the oldest waitlist entries; the query is
+    eventually consistent, so handOver() re-reads them."""
+    return WaitlistEntry.query(
+        WaitlistEntry.conferenceKey == conference_key
+    ).order(WaitlistEntry.created).fetch(limit, keys_only=True)
+
+
+def handOver(conference_key, entry_keys, shard_key):
+    """Give a seat freed in the enclosing (cross-group) transaction to the
+    first user of entry_keys still waiting, as a hold; if there is none,
+    return the seat to shard. Returns the user id it went to, or None."""
+    for entry in ndb.get_multi(entry_keys):
+        if not entry:
+            # promoted or withdrawn meanwhile
+            continue
+        entry.key.delete()
+        profile_key = ndb.Key(Profile, entry.userId)
+        if (_registrationKey(conference_key, profile_key).get() or
+                holdKey(conference_key, profile_key).get()):
+            continue
+        hold = SeatHold(key=holdKey(conference_key, profile_key),
+                        conferenceKey=conference_key,
+                        expires=datetime.datetime.utcnow() +
+                                datetime.timedelta(seconds=PROMOTED_HOLD_SECONDS))
+        hold.put()
+        _scheduleExpiry(hold)
+        return entry.userId
+    seats.returnSeat(shard_key).put()
+    return None
+
+
+@ndb.transactional(xg=True)
+def _expireTxn(hold_key, entry_keys, shard_key):
+    hold = hold_key.get()
+    # confirmed, or extended since this task was queued
+    if not hold or hold.expires > datetime.datetime.utcnow():
+        return (False, None)
+    hold_key.delete()
+    return (True, handOver(hold.conferenceKey, entry_keys, shard_key))
+
+
+def expireHold(hold_key):
+    """Give an expired hold's seat to the waitlist, or back to the
+    conference; returns the Conference if its free seats went up."""
+    hold = hold_key.get()
+    if not hold:
+        return None
+    conference = hold.conferenceKey.get()
+    if not conference:
+        # the conference was deleted, seats and all
+        hold_key.delete()
+        return None
+    expired, promoted = _expireTxn(hold_key, waitlistHead(conference.key),
+                                   seats.randomShard(conference))
+    if not expired:
+        return None
+    forget(conference.key, hold_key.parent().id())
+    if promoted:
+        forget(conference.key, promoted)
+        return None
+    schedulePromotion(conference.key)
+    return conference
+
+
+def joinWaitlist(conference_key, user_id):
+    """Add the user to the end of the conference's waitlist (once)."""
+    forget(conference_key, user_id)
+    return WaitlistEntry.get_or_insert(
+        waitlistKey(conference_key, user_id).id(),
+        conferenceKey=conference_key, userId=user_id)
+
+
+def leaveWaitlist(conference_key, user_id):
+    """Remove the user from the waitlist if they are on it; returns True
+    if they were."""
+    entry_key = waitlistKey(conference_key, user_id)
+    if not entry_key.get():
+        return False
+    entry_key.delete()
+    forget(conference_key, user_id)
+    return True
+
+
+def schedulePromotion(conference_key):
+    """Offer newly free seats to the waitlist, in the background."""
+    return taskqueue.Queue().add_async(taskqueue.Task(
+        params={'webSafeKey': conference_key.urlsafe()},
+        url='/tasks/promote_waitlist'))
+
+
+@ndb.transactional(xg=True)
+def _promoteTxn(entry_key, conference_key, profile_key, shard_key):
+    entry = entry_key.get()
+    if not entry:
+        # promoted or withdrawn meanwhile
+        return False
+    entry_key.delete()
+    if (_registrationKey(conference_key, profile_key).get() or
+            holdKey(conference_key, profile_key).get()):
+        return False
+
+    shard = seats.takeSeat(shard_key)
+    hold = SeatHold(key=holdKey(conference_key, profile_key),
+                    conferenceKey=conference_key,
+                    expires=datetime.datetime.utcnow() +
+                            datetime.timedelta(seconds=PROMOTED_HOLD_SECONDS))
+    ndb.put_multi([hold, shard])
+    _scheduleExpiry(hold)
+    return True
+
+
+def promoteWaitlist(conference):
+    """Give free seats to the oldest waitlist entries as holds; returns
+    how many users were promoted."""
+    entries = WaitlistEntry.query(
+        WaitlistEntry.conferenceKey == conference.key
+    ).order(WaitlistEntry.created).fetch(PROMOTE_BATCH)
+
+    promoted = 0
+    for entry in entries:
+        profile_key = ndb.Key(Profile, entry.userId)
+        for shard_key in seats.candidateShards(conference):
+            try:
+                if _promoteTxn(entry.key, conference.key, profile_key,
+                               shard_key):
+                    promoted += 1
+                break
+            except seats.ShardExhausted:
+                continue
+        else:
+            # no seats left
+            break
+        forget(conference.key, entry.userId)
+    return promoted
+
+
+def status(conference_key, profile_key):
+    """Return the user's reservation as a dict: state ('registered',
+    'held', 'waitlisted' or 'none'), holdExpires and waitlistPosition."""
+    user_id = profile_key.id()
+    cache_key = MEMCACHE_STATUS_KEY % (conference_key.urlsafe(), user_id)
+    result = memcache.get(cache_key)
+    if result is not None:
+        return result
+
+    registration, hold, entry = ndb.get_multi([
+        _registrationKey(conference_key, profile_key),
+        holdKey(conference_key, profile_key),
+        waitlistKey(conference_key, user_id)])
+    result = {'state': 'none', 'holdExpires': None, 'waitlistPosition': None}
+    if registration:
+        result['state'] = 'registered'
+    elif hold:
+        result['state'] = 'held'
+        result['holdExpires'] = hold.expires
+    elif entry:
+        result['state'] = 'waitlisted'
+        result['waitlistPosition'] = WaitlistEntry.query(
+            WaitlistEntry.conferenceKey == conference_key,
+            WaitlistEntry.created < entry.created).count() + 1
+    memcache.set(cache_key, result, time=STATUS_CACHE_TTL)
+    return result
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counters for conferences. A conference's available seats
+are split across up to SEAT_SHARDS SeatShard entities, each its own
+entity group, so concurrent registrations only contend when they pick
+the same shard. No shard ever goes below zero, so the shards can never
+hand out more seats than the conference had.
+
+Conference.seatsAvailable is kept as a denormalized total (used by the
+announcement query and by listings); it is refreshed by a deferred
+'/tasks/sync_seats' task rather than on every registration.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+
+SEAT_SHARDS = 10
+MEMCACHE_SEATS_KEY = "seats:%s"
+SEATS_CACHE_TTL = 60
+# at most one seatsAvailable sync per conference per interval (seconds)
+SYNC_INTERVAL = 10
+
+
+class ShardExhausted(Exception):
+    """Raised inside a registration transaction when the shard is empty."""
+
+
+class SeatsTaken(Exception):
+    """Raised by resize() when fewer seats are free than must be removed."""
+
+
+def shardKeys(conference):
+    """Return the SeatShard keys belonging to a conference."""
+    urlsafe = conference.key.urlsafe()
+    return [ ndb.Key(SeatShard, '%s-%d' % (urlsafe, index))
+             for index in range(conference.seatShards) ]
+
+
+def initShards(conference):
+    """Split conference.seatsAvailable over new (unsaved) SeatShards.
+    Sets conference.seatShards; the caller must put both."""
+    seats = max(conference.seatsAvailable or 0, 0)
+    conference.seatShards = min(SEAT_SHARDS, max(seats, 1))
+    share, remainder = divmod(seats, conference.seatShards)
+    return [ SeatShard(key=key, seats=share + (1 if index < remainder else 0))
+             for index, key in enumerate(shardKeys(conference)) ]
+
+
+@ndb.transactional(xg=True)
+def _migrateConference(conference_key):
+    conference = conference_key.get()
+    if not conference.seatShards:
+        ndb.put_multi([conference] + initShards(conference))
+    return conference
+
+
+def ensureShards(conference):
+    """Return conference, sharding its seats first if it predates shards."""
+    if conference.seatShards:
+        return conference
+    return _migrateConference(conference.key)
+
+
+def seatsAvailable(conference):
+    """Return the summed seat count, served from memcache when possible."""
+    cache_key = MEMCACHE_SEATS_KEY % conference.key.urlsafe()
+    total = memcache.get(cache_key)
+    if total is None:
+        total = _sumShards(conference)
+        memcache.add(cache_key, total, time=SEATS_CACHE_TTL)
+    return total
+
+
+def cacheTotal(conference_key, total):
+    """Cache a seat total known to be exact, e.g. read in a transaction;
+    None drops it (a deleted conference)."""
+    cache_key = MEMCACHE_SEATS_KEY % conference_key.urlsafe()
+    if total is None:
+        memcache.delete(cache_key)
+    else:
+        memcache.set(cache_key, total, time=SEATS_CACHE_TTL)
+
+
+def _sumShards(conference):
+    return sum(shard.seats for shard in ndb.get_multi(shardKeys(conference))
+               if shard)
+
+
+def candidateShards(conference):
+    """Return keys of shards that currently have seats, in random order."""
+    keys = shardKeys(conference)
+    keys = [ key for key, shard in zip(keys, ndb.get_multi(keys))
+             if shard and shard.seats > 0 ]
+    random.shuffle(keys)
+    return keys
+
+
+def randomShard(conference):
+    """Return the key of a random shard, used to give a seat back."""
+    return random.choice(shardKeys(conference))
+
+
+def takeSeat(shard_key):
+    """Take one seat from a shard; must run inside a transaction."""
+    shard = shard_key.get()
+    if not shard or shard.seats <= 0:
+        raise ShardExhausted()
+    shard.seats -= 1
+    return shard
+
+
+def returnSeat(shard_key):
+    """Give one seat back to a shard; must run inside a transaction."""
+    shard = shard_key.get() or SeatShard(key=shard_key, seats=0)
+    shard.seats += 1
+    return shard
+
+
+def resize(conference, delta):
+    """Add (or with a negative delta, remove) free seats; must run inside
+    a cross-group transaction. Returns the changed shards (to put) and
+    the new total. Growing may add shards (updating conference.seatShards);
+    removing takes from the fullest shards and raises SeatsTaken if
+    fewer than -delta seats are free."""
+    shards = [ shard or SeatShard(key=key, seats=0) for key, shard in
+               zip(shardKeys(conference), ndb.get_multi(shardKeys(conference))) ]
+    before = dict( (shard.key, shard.seats) for shard in shards )
+    total = sum(before.values())
+    if total + delta < 0:
+        raise SeatsTaken()
+
+    if delta > 0:
+        wanted = min(SEAT_SHARDS, max(total + delta, 1))
+        if wanted > conference.seatShards:
+            conference.seatShards = wanted
+            shards.extend( SeatShard(key=key, seats=0)
+                           for key in shardKeys(conference)[len(shards):] )
+        # spread the new seats, emptiest shards first
+        shards.sort(key=lambda shard: shard.seats)
+        share, remainder = divmod(delta, len(shards))
+        for index, shard in enumerate(shards):
+            shard.seats += share + (1 if index < remainder else 0)
+    else:
+        shards.sort(key=lambda shard: -shard.seats)
+        remaining = -delta
+        for shard in shards:
+            taken = min(shard.seats, remaining)
+            shard.seats -= taken
+            remaining -= taken
+    changed = [ shard for shard in shards
+                if shard.seats != before.get(shard.key) ]
+    return (changed, total + delta)
+
+
+def seatsChanged(conference, delta):
+    """Record a committed change of delta seats: adjust the cached total
+    and schedule a (deduplicated) sync of Conference.seatsAvailable.
+    Returns the new cached total, or None if it was not cached."""
+    cache_key = MEMCACHE_SEATS_KEY % conference.key.urlsafe()
+    if delta < 0:
+        total = memcache.decr(cache_key, -delta)
+    else:
+        total = memcache.incr(cache_key, delta)
+
+    urlsafe = conference.key.urlsafe()
+    try:
+        taskqueue.add(
+            name='sync-seats-%s-%d' % (urlsafe, int(time.time() / SYNC_INTERVAL)),
+            params={'webSafeKey': urlsafe},
+            url='/tasks/sync_seats',
+            countdown=SYNC_INTERVAL,
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # a sync for this interval is already on its way
+        pass
+    return total
+
+
+@ndb.transactional
+def _storeTotal(conference_key, total):
+    conference = conference_key.get()
+    if conference and conference.seatsAvailable != total:
+        conference.seatsAvailable = total
+        conference.put()
+        return True
+    return False
+
+
+def syncConference(conference_key):
+    """Write the summed shard count back to Conference.seatsAvailable.
+    Returns True if the stored value changed."""
+    conference = conference_key.get()
+    if not conference or not conference.seatShards:
+        return False
+    total = _sumShards(conference)
+    cacheTotal(conference_key, total)
+    return _storeTotal(conference_key, total)
@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $http, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -414,6 +414,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferences = function () {
         $scope.submitted = false;
+        // Only the "All" listing is paged by the server.
+        $scope.nextPageToken = null;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
         } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
@@ -424,7 +426,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Queries conferences through the anonymous /public/conferences listing,
+     * which the browser (and edge) can cache and revalidate with ETags.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
@@ -440,33 +443,64 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
-        $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
-            execute(function (resp) {
-                $scope.$apply(function () {
-                    $scope.loading = false;
-                    if (resp.error) {
-                        // The request has failed.
-                        var errorMessage = resp.error.message || '';
-                        $scope.messages = 'Failed to query conferences : ' + errorMessage;
-                        $scope.alertStatus = 'warning';
-                        $log.error($scope.messages + ' filters : ' + JSON.stringify(sendFilters));
-                    } else {
-                        // The request has succeeded.
-                        $scope.submitted = false;
-                        $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
-                        $scope.alertStatus = 'success';
-                        $log.info($scope.messages);
+        $scope.listing = {
+            params: {
+                filter: sendFilters.filters.map(function (filter) {
+                    return [filter.field, filter.operator, filter.value].join(',');
+                })
+            },
+            description: JSON.stringify(sendFilters)
+        };
+        $scope.conferences = [];
+        $scope.pagination.currentPage = 0;
+        $scope.loadMoreConferences();
+    }
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
-                    }
-                    $scope.submitted = true;
+    /**
+     * Fetches the next page of the /public/conferences listing queried by
+     * queryConferencesAll, appending it to $scope.conferences and showing it.
+     */
+    $scope.loadMoreConferences = function () {
+        var listing = $scope.listing;
+        listing.params.pageToken = $scope.nextPageToken || undefined;
+        $scope.nextPageToken = null;
+        $scope.loading = true;
+        $http.get('/public/conferences', {params: listing.params}).
+            success(function (resp) {
+                if (listing !== $scope.listing) {
+                    // A newer query has replaced this one.
+                    return;
+                }
+                $scope.loading = false;
+                // The request has succeeded.
+                $scope.submitted = false;
+                $scope.messages = 'Query succeeded : ' + listing.description;
+                $scope.alertStatus = 'success';
+                $log.info($scope.messages);
+
+                var firstNew = $scope.conferences.length;
+                angular.forEach(resp.items, function (conference) {
+                    $scope.conferences.push(conference);
                 });
+                if (resp.items && resp.items.length > 0) {
+                    $scope.pagination.currentPage =
+                        Math.floor(firstNew / $scope.pagination.pageSize);
+                }
+                $scope.nextPageToken = resp.nextPageToken || null;
+                $scope.submitted = true;
+            }).
+            error(function (resp) {
+                if (listing !== $scope.listing) {
+                    return;
+                }
+                $scope.loading = false;
+                // The request has failed.
+                $scope.messages = 'Failed to query conferences : ' + (resp || '');
+                $scope.alertStatus = 'warning';
+                $log.error($scope.messages + ' filters : ' + listing.description);
+                $scope.submitted = true;
             });
-    }
+    };
 
     /**
      * Invokes the conference.getConferencesCreated method.
@@ -547,37 +581,34 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $http, $routeParams, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Gets the conference from the cacheable /public/conferences/<key> view
+     * and sets it in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
-        }).execute(function (resp) {
-            $scope.$apply(function () {
+        $http.get('/public/conferences/' + encodeURIComponent($routeParams.websafeConferenceKey)).
+            success(function (resp) {
                 $scope.loading = false;
-                if (resp.error) {
-                    // The request has failed.
-                    var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
-                        + ' ' + errorMessage;
-                    $scope.alertStatus = 'warning';
-                    $log.error($scope.messages);
-                } else {
-                    // The request has succeeded.
-                    $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
+                // The request has succeeded.
+                $scope.alertStatus = 'success';
+                $scope.conference = resp;
+            }).
+            error(function (resp) {
+                $scope.loading = false;
+                // The request has failed.
+                $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeConferenceKey
+                    + ' ' + (resp || '');
+                $scope.alertStatus = 'warning';
+                $log.error($scope.messages);
             });
-        });
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
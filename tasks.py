@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""tasks.py
+
+Work done by the push task, pull queue and migration handlers in
+main.py: registration and search key backfills, display name and seat
+count propagation, hold expiry, waitlist promotion and the cleanup
+after a conference is deleted.
+
+Kept apart from conference.py so that main.py serves these requests
+without importing Endpoints and the whole ConferenceApi.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import announcement
+from cache import QUERY_CACHE
+from models import Conference, Profile, Registration, WaitlistEntry
+import planner
+import reservations
+import seats
+
+
+# pull queue of webSafeKeys tagged with the organizer's email; drained
+# by the /crons/send_confirmation_emails job in main.py
+CONFIRMATION_QUEUE = 'confirmation-emails'
+# conferences (of one organizer, i.e. entity group) per transaction
+DISPLAY_NAME_BATCH = 100
+
+
+def confirmationTask(conference, email):
+    """Return the pull task asking the mailer to confirm conference."""
+    return taskqueue.Task( payload = conference.key.urlsafe(),
+                           method = 'PULL',
+                           tag = email )
+
+
+@ndb.transactional
+def migrateRegistrations(profile_key):
+    """Move a Profile's legacy conferenceKeysToAttend list into
+    Registration entities (same entity group), returning the Profile."""
+    profile = profile_key.get()
+    if not profile or not profile.conferenceKeysToAttend:
+        return profile
+
+    registrations = [
+        Registration( key = ndb.Key(Registration, webSafeKey,
+                                    parent=profile_key),
+                      conferenceKey = ndb.Key(urlsafe=webSafeKey) )
+        for webSafeKey in set(profile.conferenceKeysToAttend)
+    ]
+    profile.conferenceKeysToAttend = []
+    ndb.put_multi([profile] + registrations)
+    return profile
+
+
+def migrateRegistrationBatch(pageToken=None, batchSize=100):
+    """Migrate one batch of Profiles still holding legacy
+    conferenceKeysToAttend; returns a token for the next batch or None.
+    Used by the /tasks/migrate_registrations task."""
+    query = Profile.query(Profile.conferenceKeysToAttend > '')
+    cursor = Cursor(urlsafe=pageToken) if pageToken else None
+    profileKeys, next_cursor, more = query.fetch_page(
+        batchSize, start_cursor=cursor, keys_only=True)
+    for profile_key in profileKeys:
+        migrateRegistrations(profile_key)
+    if more and next_cursor:
+        return next_cursor.urlsafe()
+    return None
+
+
+def resaveConferenceBatch(pageToken=None, batchSize=100):
+    """Re-put and re-index one batch of Conferences so computed
+    properties (e.g. searchKeys) and search documents get written;
+    returns a token for the next batch or None. Used by the
+    /tasks/resave_conferences task."""
+    # the Search API is only needed by this (rare) backfill
+    import textsearch
+
+    cursor = Cursor(urlsafe=pageToken) if pageToken else None
+    conferenceKeys, next_cursor, more = Conference.query().fetch_page(
+        batchSize, start_cursor=cursor, keys_only=True)
+    # re-read in a transaction each, so seat syncs and edits committed
+    # since the query are written back rather than reverted
+    conferences = [ conference for conference in
+                    (_resaveConference(key) for key in conferenceKeys)
+                    if conference ]
+    textsearch.indexConferences(conferences)
+    if more and next_cursor:
+        return next_cursor.urlsafe()
+    return None
+
+
+@ndb.transactional
+def _resaveConference(conference_key):
+    conference = conference_key.get()
+    if conference:
+        conference.put()
+    return conference
+
+
+def propagateDisplayName(user_id):
+    """Copy a Profile's displayName onto every Conference it organizes;
+    used by the /tasks/propagate_display_name task queued by saveProfile."""
+    profile = ndb.Key(Profile, user_id).get()
+    if not profile:
+        return
+
+    # organizers are the ancestors of their conferences, so all of them
+    # share the Profile's entity group. They are re-read and written in
+    # transactions of DISPLAY_NAME_BATCH, so seat syncs and edits landing
+    # meanwhile are not overwritten
+    conferenceKeys = Conference.query(ancestor=profile.key).fetch(
+        keys_only=True)
+    cities = set()
+    for start in range(0, len(conferenceKeys), DISPLAY_NAME_BATCH):
+        cities |= _storeDisplayName(
+            conferenceKeys[start:start + DISPLAY_NAME_BATCH],
+            profile.displayName)
+    if cities:
+        QUERY_CACHE.bump(planner.changeScopes(cities))
+
+
+@ndb.transactional
+def _storeDisplayName(conference_keys, displayName):
+    """Returns the cities of the conferences changed."""
+    stale = [ conference for conference in ndb.get_multi(conference_keys)
+              if conference and
+                 conference.organizerDisplayName != displayName ]
+    for conference in stale:
+        conference.organizerDisplayName = displayName
+    ndb.put_multi(stale)
+    return set( conference.city for conference in stale )
+
+
+def syncSeats(webSafeKey):
+    """Copy the sharded seat total onto the Conference entity;
+    used by the /tasks/sync_seats task queued on (un)registration."""
+    conference_key = ndb.Key(urlsafe=webSafeKey)
+    if seats.syncConference(conference_key):
+        # listings show Conference.seatsAvailable; the get is served from
+        # ndb's context cache
+        conference = conference_key.get()
+        QUERY_CACHE.bump(planner.changeScopes([conference and conference.city]))
+
+
+def expireHold(holdKey):
+    """Return an expired hold's seat; used by the /tasks/expire_hold
+    task queued with every hold."""
+    conference = reservations.expireHold(ndb.Key(urlsafe=holdKey))
+    if conference:
+        seatsLeft = seats.seatsChanged(conference, 1)
+        announcement.updateNearSoldOut(conference, seatsLeft)
+
+
+def promoteWaitlist(webSafeKey):
+    """Turn waitlist entries into holds while seats are free; used by
+    the /tasks/promote_waitlist task."""
+    conference = ndb.Key(urlsafe=webSafeKey).get()
+    if not conference:
+        return
+    promoted = reservations.promoteWaitlist(seats.ensureShards(conference))
+    if promoted:
+        seatsLeft = seats.seatsChanged(conference, -promoted)
+        announcement.updateNearSoldOut(conference, seatsLeft)
+
+
+def deleteRegistrationBatch(webSafeKey, batchSize=100):
+    """Remove up to batchSize Registrations, legacy Profile entries and
+    waitlist entries of a deleted conference; returns True while more
+    may be left. Used by the /tasks/delete_registrations task queued by
+    deleteConference."""
+    conference_key = ndb.Key(urlsafe=webSafeKey)
+
+    # legacy lists are migrated first, so their entry for this
+    # conference becomes a Registration (with a known key) as well
+    legacy = Profile.query(
+        Profile.conferenceKeysToAttend == webSafeKey
+    ).fetch(batchSize, keys_only=True)
+    for profile_key in legacy:
+        migrateRegistrations(profile_key)
+
+    registrations = Registration.query(
+        Registration.conferenceKey == conference_key
+    ).fetch(batchSize, keys_only=True)
+    waiting = WaitlistEntry.query(
+        WaitlistEntry.conferenceKey == conference_key
+    ).fetch(batchSize, keys_only=True)
+
+    doomed = set(registrations) | set(waiting)
+    doomed.update( ndb.Key(Registration, webSafeKey, parent=profile_key)
+                   for profile_key in legacy )
+    ndb.delete_multi(list(doomed))
+    return batchSize in (len(legacy), len(registrations), len(waiting))
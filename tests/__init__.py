@@ -0,0 +1,26 @@
+"""tests
+
+Unit tests for the logic that needs no deployed instance: the local text
+search index, query planning and seat resizing. The modules under test
+import the App Engine SDK, so the SDK (from the APPENGINE_SDK environment
+variable) and the app are put on sys.path here, and datastore access runs
+against the SDK's testbed stubs. From the repository root:
+
+    APPENGINE_SDK=/path/to/google_appengine \\
+        python -m unittest discover -s tests -t .
+
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_sdk = os.environ.get('APPENGINE_SDK')
+if _sdk and _sdk not in sys.path:
+    sys.path.insert(0, _sdk)
+import dev_appserver
+dev_appserver.fix_sys_path()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault('APPLICATION_ID', 'conference-test')
@@ -0,0 +1,156 @@
+"""Tests for planner.py: filter parsing, cache keys and scopes, and the
+strategy plan() picks per filter shape."""
+
+import unittest
+
+from models import ConferenceQueryForm, ConferenceQueryForms
+import planner
+
+
+def request(*filters, **options):
+    return ConferenceQueryForms(
+        filters=[ ConferenceQueryForm(field=field, operator=operator,
+                                      value=value)
+                  for field, operator, value in filters ],
+        **options)
+
+
+def plan(*filters, **options):
+    inequality_field, formatted = planner.formatFilters(
+        request(*filters).filters)
+    return planner.plan(inequality_field, formatted,
+                        options.get('paged', False))
+
+
+class FakeConference(object):
+
+    def __init__(self, **properties):
+        self.__dict__.update(properties)
+
+
+class FormatFiltersTest(unittest.TestCase):
+
+    def testMapsFieldsAndOperators(self):
+        inequality_field, filters = planner.formatFilters(request(
+            ('CITY', 'EQ', 'London'), ('MONTH', 'GT', '6')).filters)
+        self.assertEqual(inequality_field, 'month')
+        self.assertEqual(filters, [
+            {'field': 'city', 'operator': '=', 'value': 'London'},
+            {'field': 'month', 'operator': '>', 'value': 6}])
+
+    def testRejectsUnknownFieldsAndOperators(self):
+        self.assertRaises(planner.FilterError, planner.formatFilters,
+                          request(('NAME', 'EQ', 'x')).filters)
+        self.assertRaises(planner.FilterError, planner.formatFilters,
+                          request(('CITY', 'LIKE', 'x')).filters)
+
+    def testRejectsNonNumericValues(self):
+        self.assertRaises(planner.FilterError, planner.formatFilters,
+                          request(('MAX_ATTENDEES', 'GT', 'many')).filters)
+
+    def testOneInequalityFieldOnly(self):
+        self.assertRaises(planner.FilterError, planner.formatFilters,
+                          request(('MONTH', 'GT', '6'),
+                                  ('MAX_ATTENDEES', 'LT', '10')).filters)
+        inequality_field, filters = planner.formatFilters(request(
+            ('MONTH', 'GT', '6'), ('MONTH', 'LT', '9')).filters)
+        self.assertEqual(inequality_field, 'month')
+
+
+class CacheKeyTest(unittest.TestCase):
+
+    def testIgnoresFilterOrder(self):
+        self.assertEqual(
+            planner.cacheKey(request(('CITY', 'EQ', 'London'),
+                                     ('MONTH', 'EQ', '6'))),
+            planner.cacheKey(request(('MONTH', 'EQ', '6'),
+                                     ('CITY', 'EQ', 'London'))))
+
+    def testViewsAndPagesDiffer(self):
+        key, scope = planner.cacheKey(request())
+        summaryKey, summaryScope = planner.cacheKey(request(), 'summary')
+        pagedKey, pagedScope = planner.cacheKey(request(pageSize=10))
+        self.assertNotEqual(key, summaryKey)
+        self.assertNotEqual(scope, summaryScope)
+        self.assertNotEqual(key, pagedKey)
+        self.assertEqual(scope, pagedScope)
+
+    def testScopedByCityEquality(self):
+        key, london = planner.cacheKey(request(('CITY', 'EQ', 'London'),
+                                               ('MONTH', 'EQ', '6')))
+        key, paris = planner.cacheKey(request(('CITY', 'EQ', 'Paris')))
+        key, anywhere = planner.cacheKey(request(('MONTH', 'EQ', '6')))
+        key, after = planner.cacheKey(request(('CITY', 'GT', 'London')))
+        self.assertEqual(len(set([london, paris, anywhere])), 3)
+        self.assertEqual(after, anywhere)
+
+    def testChangeScopesCoverAffectedQueries(self):
+        key, london = planner.cacheKey(request(('CITY', 'EQ', u'London')))
+        key, paris = planner.cacheKey(request(('CITY', 'EQ', u'Paris')))
+        key, anywhere = planner.cacheKey(request())
+        key, summaries = planner.cacheKey(request(('CITY', 'EQ', u'London')),
+                                          'summary')
+
+        scopes = planner.changeScopes([u'London'])
+        self.assertTrue(london in scopes)
+        self.assertTrue(anywhere in scopes)
+        self.assertTrue(summaries in scopes)
+        self.assertFalse(paris in scopes)
+
+        scopes = planner.changeScopes([u'London'], ('full',))
+        self.assertTrue(london in scopes)
+        self.assertFalse(summaries in scopes)
+
+
+class PlanTest(unittest.TestCase):
+
+    def testNoFiltersUseTheProjectedNameIndex(self):
+        chosen = plan()
+        self.assertEqual(chosen.strategy, 'composite')
+        self.assertEqual(chosen.postFilters, [])
+        self.assertTrue(chosen.projectable)
+
+    def testIndexedShapeIsComposite(self):
+        chosen = plan(('CITY', 'EQ', 'London'))
+        self.assertEqual(chosen.strategy, 'composite')
+        self.assertTrue(chosen.projectable)
+
+        chosen = plan(('CITY', 'EQ', 'London'), ('MONTH', 'EQ', '6'),
+                      ('TOPIC', 'EQ', 'Web'))
+        self.assertEqual(chosen.strategy, 'composite')
+        self.assertFalse(chosen.projectable)
+
+    def testEqualitiesWithoutIndexUseSearchKeys(self):
+        chosen = plan(('CITY', 'EQ', 'London'), ('MONTH', 'EQ', '6'))
+        self.assertEqual(chosen.strategy, 'searchKey')
+        self.assertEqual(chosen.index, 'searchKeys, name')
+        self.assertEqual(chosen.postFilters, [])
+
+    def testNarrowestFilterDrivesAndSortsInMemory(self):
+        chosen = plan(('TOPIC', 'EQ', 'Web'), ('MAX_ATTENDEES', 'GT', '10'))
+        self.assertEqual(chosen.strategy, 'narrowest')
+        self.assertEqual(chosen.index, 'topics, name')
+        self.assertEqual(chosen.describe(), ['maxAttendees > 10'])
+        self.assertTrue(chosen.sortInMemory is not None)
+
+    def testPagedPlansKeepTheInequalityOrder(self):
+        chosen = plan(('TOPIC', 'EQ', 'Web'), ('MAX_ATTENDEES', 'GT', '10'),
+                      paged=True)
+        self.assertEqual(chosen.strategy, 'narrowest')
+        self.assertEqual(chosen.index, 'maxAttendees, name')
+        self.assertEqual([ f["field"] for f in chosen.postFilters ],
+                         ['topics'])
+        self.assertTrue(chosen.sortInMemory is None)
+
+    def testPostFiltersMatchAnyRepeatedValue(self):
+        chosen = plan(('TOPIC', 'EQ', 'Web'), ('MAX_ATTENDEES', 'GT', '10'))
+        self.assertTrue(chosen.matches(FakeConference(
+            topics=['Data', 'Web'], maxAttendees=20)))
+        self.assertFalse(chosen.matches(FakeConference(
+            topics=['Data', 'Web'], maxAttendees=5)))
+        self.assertFalse(chosen.matches(FakeConference(
+            topics=['Web'], maxAttendees=None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
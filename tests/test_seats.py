@@ -0,0 +1,82 @@
+"""Tests for seats.py: splitting seats over shards and resizing them."""
+
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import Conference
+import seats
+
+
+class SeatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def conference(self, seatsAvailable):
+        """Store a conference with seatsAvailable split over its shards."""
+        conference = Conference(key=ndb.Key(Conference, 1), name=u'Summit',
+                                seatsAvailable=seatsAvailable)
+        ndb.put_multi([conference] + seats.initShards(conference))
+        return conference
+
+    def shardSeats(self, conference):
+        shards = ndb.get_multi(seats.shardKeys(conference))
+        return sorted(shard.seats for shard in shards if shard)
+
+    def resize(self, conference, delta):
+        shards, total = seats.resize(conference, delta)
+        ndb.put_multi(shards)
+        return total
+
+    def testInitShardsSplitsEvenly(self):
+        conference = self.conference(25)
+        self.assertEqual(conference.seatShards, seats.SEAT_SHARDS)
+        self.assertEqual(self.shardSeats(conference), [2] * 5 + [3] * 5)
+
+    def testInitShardsNeverMoreShardsThanSeats(self):
+        self.assertEqual(self.conference(3).seatShards, 3)
+        conference = self.conference(0)
+        self.assertEqual(conference.seatShards, 1)
+        self.assertEqual(self.shardSeats(conference), [0])
+
+    def testGrowingAddsShardsAndSpreadsSeats(self):
+        conference = self.conference(3)
+        self.assertEqual(self.resize(conference, 9), 12)
+        self.assertEqual(conference.seatShards, seats.SEAT_SHARDS)
+        self.assertEqual(sum(self.shardSeats(conference)), 12)
+        self.assertEqual(self.shardSeats(conference), [1] * 8 + [2] * 2)
+
+    def testShrinkingTakesFromTheFullestShards(self):
+        conference = self.conference(3)
+        shard_keys = seats.shardKeys(conference)
+        shards = ndb.get_multi(shard_keys)
+        shards[0].seats = 5
+        ndb.put_multi(shards)
+
+        self.assertEqual(self.resize(conference, -4), 3)
+        self.assertEqual([ shard.seats for shard in ndb.get_multi(shard_keys) ],
+                         [1, 1, 1])
+
+    def testShrinkingBelowTheFreeSeatsFails(self):
+        conference = self.conference(3)
+        self.assertRaises(seats.SeatsTaken, seats.resize, conference, -4)
+        self.assertEqual(self.shardSeats(conference), [1, 1, 1])
+
+    def testOnlyChangedShardsAreReturned(self):
+        conference = self.conference(10)
+        shards, total = seats.resize(conference, -1)
+        self.assertEqual(total, 9)
+        self.assertEqual(len(shards), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Tests for textsearch.LocalIndex: ranking, term intersection,
+refinements, paging and facet counts."""
+
+import unittest
+
+import textsearch
+
+
+def document(docId, name, description='', city=None, topics=(), month=None):
+    return {
+        'docId': docId,
+        'name': name,
+        'description': description,
+        'facets': {
+            'city': [city] if city else [],
+            'topic': list(topics),
+            'month': [unicode(month)] if month else [],
+        },
+    }
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def testLowercasesAndDropsStopWords(self):
+        self.assertEqual(textsearch.tokenize(u'The Cloud and the Python'),
+                         [u'cloud', u'python'])
+
+    def testEmptyText(self):
+        self.assertEqual(textsearch.tokenize(None), [])
+
+
+class LocalIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = textsearch.LocalIndex()
+        self.index.put([
+            document('a', u'Python Summit', u'All about the cloud',
+                     city=u'London', topics=[u'Programming'], month=6),
+            document('b', u'Cloud Days', u'Python in production',
+                     city=u'Paris', topics=[u'Cloud'], month=6),
+            document('c', u'Web Week', u'Browsers and Python',
+                     city=u'London', topics=[u'Web'], month=7),
+            document('d', u'Data Camp', u'Spreadsheets',
+                     city=u'Berlin', topics=[u'Data'], month=8),
+        ])
+
+    def search(self, query, refinements=(), limit=10, pageToken=None):
+        return self.index.search(query, list(refinements), limit, pageToken)
+
+    def testNameMatchesOutrankDescriptionMatches(self):
+        results = self.search(u'python')
+        self.assertEqual(results.docIds[0], 'a')
+        self.assertEqual(sorted(results.docIds), ['a', 'b', 'c'])
+        self.assertEqual(results.total, 3)
+
+    def testEveryTermMustMatch(self):
+        self.assertEqual(sorted(self.search(u'python cloud').docIds),
+                         ['a', 'b'])
+        self.assertEqual(self.search(u'python spreadsheets').docIds, [])
+
+    def testUnknownTermMatchesNothing(self):
+        results = self.search(u'python kubernetes')
+        self.assertEqual(results.docIds, [])
+        self.assertEqual(results.total, 0)
+
+    def testEmptyQueryMatchesEverything(self):
+        self.assertEqual(sorted(self.search(u'').docIds),
+                         ['a', 'b', 'c', 'd'])
+
+    def testRefinementsFilterMatches(self):
+        results = self.search(u'python', [('city', u'London')])
+        self.assertEqual(sorted(results.docIds), ['a', 'c'])
+        results = self.search(u'python', [('city', u'London'),
+                                           ('month', u'7')])
+        self.assertEqual(results.docIds, ['c'])
+
+    def testFacetsCountEveryMatchNotJustThePage(self):
+        results = self.search(u'python', limit=1)
+        self.assertEqual(len(results.docIds), 1)
+        self.assertEqual(results.facets['city'],
+                         [(u'London', 2), (u'Paris', 1)])
+        self.assertEqual(results.facets['month'], [(u'6', 2), (u'7', 1)])
+        self.assertEqual(results.facets['topic'],
+                         [(u'Cloud', 1), (u'Programming', 1), (u'Web', 1)])
+
+    def testPagesFollowTheRanking(self):
+        everything = self.search(u'').docIds
+        first = self.search(u'', limit=3)
+        self.assertEqual(first.docIds, everything[:3])
+        self.assertEqual(first.nextPageToken, '3')
+        second = self.search(u'', limit=3, pageToken=first.nextPageToken)
+        self.assertEqual(second.docIds, everything[3:])
+        self.assertEqual(second.nextPageToken, None)
+
+    def testInvalidPageToken(self):
+        self.assertRaises(ValueError, self.search, u'python',
+                          pageToken='not-a-token')
+
+    def testPutReplacesTheDocument(self):
+        self.index.put([document('a', u'Golang Summit', city=u'Rome')])
+        self.assertEqual(sorted(self.search(u'python').docIds), ['b', 'c'])
+        self.assertEqual(self.search(u'golang').docIds, ['a'])
+        self.assertEqual(self.search(u'', [('city', u'Rome')]).docIds, ['a'])
+
+    def testDelete(self):
+        self.index.delete(['a', 'missing'])
+        self.assertEqual(sorted(self.search(u'python').docIds), ['b', 'c'])
+        self.assertEqual(self.search(u'', [('city', u'London')]).docIds,
+                         ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Full-text, faceted search over conferences. Conference names and
+descriptions are tokenized into an inverted index, so a text query is a
+posting-list lookup rather than a datastore scan; every search also
+returns facet counts (city, topic, month) over all of its matches.
+
+Two interchangeable backends implement put() / delete() / search():
+
+    SearchApiIndex -- the App Engine Search API (production)
+    LocalIndex     -- an in-process inverted index, for offline runs,
+                      benchmarks and the SDK stubs
+
+Set CONFERENCE_SEARCH_BACKEND=local in the environment to use LocalIndex.
+Index entries are written when conferences are created or imported, and
+rebuilt by /tasks/resave_conferences.
+
+"""
+
+import collections
+import math
+import os
+import re
+import threading
+
+from google.appengine.api import search
+
+import applog
+
+log = applog.getLogger(__name__)
+
+
+INDEX_NAME = 'conferences'
+# facet dimensions, in the order they are returned
+FACETS = ('city', 'topic', 'month')
+# a query term found in the name counts this many times over
+NAME_BOOST = 3
+MAX_FACET_VALUES = 20
+STOP_WORDS = frozenset(['a', 'an', 'and', 'at', 'for', 'in', 'of', 'on',
+                        'or', 'the', 'to', 'with'])
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# docIds     -- webSafeKeys of this page of matches, best first
+# facets     -- {facet: [(value, count), ...]} over all matches
+SearchResults = collections.namedtuple(
+    'SearchResults', 'docIds nextPageToken facets total')
+
+
+def tokenize(text):
+    """Split text into lowercased search terms."""
+    return [ token for token in _TOKEN.findall((text or u'').lower())
+             if token not in STOP_WORDS ]
+
+
+def documentFor(conference):
+    """Return the backend-neutral search document for a Conference."""
+    return {
+        'docId': conference.key.urlsafe(),
+        'name': conference.name or u'',
+        'description': conference.description or u'',
+        'facets': {
+            'city': [conference.city] if conference.city else [],
+            'topic': list(conference.topics or []),
+            'month': [unicode(conference.month)] if conference.month else [],
+        },
+    }
+
+
+def _topFacets(counts):
+    """Return {facet: [(value, count), ...]}, most frequent values first."""
+    return dict( (facet, sorted(counts[facet].items(),
+                                key=lambda item: (-item[1], item[0])
+                                )[:MAX_FACET_VALUES])
+                 for facet in FACETS )
+
+
+class LocalIndex(object):
+    """LocalIndex -- thread-safe in-memory inverted index"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # term -> {docId: weighted term frequency}
+        self._postings = collections.defaultdict(dict)
+        # docId -> (terms, facets)
+        self._documents = {}
+
+    def _remove(self, docId):
+        terms, facets = self._documents.pop(docId, ((), None))
+        for term in terms:
+            posting = self._postings[term]
+            posting.pop(docId, None)
+            if not posting:
+                del self._postings[term]
+
+    def put(self, documents):
+        with self._lock:
+            for document in documents:
+                docId = document['docId']
+                self._remove(docId)
+                weights = collections.Counter()
+                for term in tokenize(document['name']):
+                    weights[term] += NAME_BOOST
+                for term in tokenize(document['description']):
+                    weights[term] += 1
+                for term, weight in weights.iteritems():
+                    self._postings[term][docId] = weight
+                self._documents[docId] = (weights.keys(), document['facets'])
+
+    def delete(self, docIds):
+        with self._lock:
+            for docId in docIds:
+                self._remove(docId)
+
+    def search(self, query, refinements, limit, pageToken=None):
+        """Return SearchResults for documents containing every query term
+        and every (facet, value) refinement, ranked by TF-IDF."""
+        try:
+            offset = int(pageToken or 0)
+        except ValueError:
+            raise ValueError('Invalid page token.')
+        terms = set(tokenize(query))
+
+        with self._lock:
+            total = len(self._documents)
+            # intersect the shortest posting lists first
+            postings = sorted( (self._postings.get(term, {}) for term in terms),
+                               key=len )
+            if postings:
+                matches = set(postings[0])
+                for posting in postings[1:]:
+                    matches.intersection_update(posting)
+            else:
+                matches = set(self._documents)
+
+            counts = dict((facet, collections.Counter()) for facet in FACETS)
+            scored = []
+            for docId in matches:
+                facets = self._documents[docId][1]
+                if any(value not in facets.get(facet, ())
+                       for facet, value in refinements):
+                    continue
+                score = sum( posting[docId] *
+                             math.log(1.0 + float(total) / len(posting))
+                             for posting in postings )
+                scored.append((-score, docId))
+                for facet in FACETS:
+                    counts[facet].update(facets.get(facet, ()))
+
+        scored.sort()
+        page = [ docId for negScore, docId in scored[offset:offset + limit] ]
+        nextPageToken = None
+        if offset + limit < len(scored):
+            nextPageToken = str(offset + limit)
+        return SearchResults(page, nextPageToken, _topFacets(counts),
+                             len(scored))
+
+
+class SearchApiIndex(object):
+    """SearchApiIndex -- the same interface on the App Engine Search API"""
+
+    def __init__(self, name):
+        self.index = search.Index(name=name)
+
+    @staticmethod
+    def _document(document):
+        fields = [ search.TextField(name='name', value=document['name']),
+                   search.TextField(name='description',
+                                    value=document['description']) ]
+        facets = []
+        for facet in FACETS:
+            for value in document['facets'][facet]:
+                fields.append(search.AtomField(name=facet, value=value))
+                facets.append(search.AtomFacet(name=facet, value=value))
+        return search.Document(doc_id=document['docId'], fields=fields,
+                               facets=facets)
+
+    def put(self, documents):
+        documents = [ self._document(document) for document in documents ]
+        step = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        for start in range(0, len(documents), step):
+            try:
+                self.index.put(documents[start:start + step])
+            except search.Error:
+                # the conferences are stored already; the resave task
+                # rebuilds whatever did not make it into the index
+                log.exception('search_index_failed',
+                              documents=len(documents[start:start + step]))
+
+    def delete(self, docIds):
+        step = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        for start in range(0, len(docIds), step):
+            try:
+                self.index.delete(docIds[start:start + step])
+            except search.Error:
+                # the conferences are deleted already; searchConferences
+                # skips documents whose conference no longer exists
+                log.exception('search_unindex_failed',
+                              documents=len(docIds[start:start + step]))
+
+    def search(self, query, refinements, limit, pageToken=None):
+        parts = [ '"%s"' % term for term in tokenize(query) ]
+        parts.extend( '%s:"%s"' % (facet, value.replace('"', ''))
+                      for facet, value in refinements )
+        try:
+            cursor = search.Cursor(web_safe_string=pageToken) \
+                if pageToken else search.Cursor()
+        except ValueError:
+            raise ValueError('Invalid page token.')
+
+        options = search.QueryOptions(
+            limit=limit,
+            cursor=cursor,
+            ids_only=True,
+            sort_options=search.SortOptions(
+                match_scorer=search.MatchScorer(),
+                expressions=[search.SortExpression(
+                    expression='_score',
+                    direction=search.SortExpression.DESCENDING,
+                    default_value=0)]))
+        results = self.index.search(search.Query(
+            query_string=' '.join(parts),
+            options=options,
+            return_facets=[ search.FacetRequest(facet,
+                                                value_limit=MAX_FACET_VALUES)
+                            for facet in FACETS ]))
+
+        facets = dict((facet, []) for facet in FACETS)
+        for facet in results.facets:
+            facets[facet.name] = [ (value.label, value.count)
+                                   for value in facet.values ]
+        nextPageToken = None
+        if results.cursor:
+            nextPageToken = results.cursor.web_safe_string
+        return SearchResults([ document.doc_id for document in results ],
+                             nextPageToken, facets, results.number_found)
+
+
+if os.environ.get('CONFERENCE_SEARCH_BACKEND') == 'local':
+    INDEX = LocalIndex()
+else:
+    INDEX = SearchApiIndex(INDEX_NAME)
+
+
+def indexConferences(conferences):
+    """Add or refresh the search documents of conferences."""
+    INDEX.put([ documentFor(conference) for conference in conferences ])
+
+
+def unindexConferences(conference_keys):
+    """Remove conferences from the search index."""
+    INDEX.delete([ key.urlsafe() for key in conference_keys ])
@@ -1,10 +1,27 @@
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 
-from google.appengine.api import urlfetch
-from models import Profile
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from models import Profile, UserEmail
+from cache import LocalLRU
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?{}={}'
+TOKENINFO_DEADLINE = 5          # seconds per tokeninfo RPC
+TOKENINFO_ATTEMPTS = 3
+# verified token -> user id, never cached past the token's own expiry
+TOKEN_CACHE_TTL = 3600
+# holds (user id, absolute expiry); v2 since the expiry was added
+MEMCACHE_TOKEN_KEY = "tokeninfo:v2:%s"
+_tokenCache = LocalLRU(maxsize=2000, ttl=TOKEN_CACHE_TTL)
+# lookups currently running in this instance, shared by concurrent requests
+_inflight = {}
+_inflightLock = threading.Lock()
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,32 +31,121 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?{}={}'.\
-               format(token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            response = urlfetch.fetch(url)
-            if response.status_code == 200:
-                user = json.loads(response.content)
-                break
-            elif response.status_code == 400 and 'invalid_token' in response.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?{}={}'.\
-                       format('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getOAuthUserId(token)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorithm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
+        # this is just a sample that looks the email up in UserEmail (one
+        # cached key get) and generates an id if there is no mapping yet
+        email = user.email()
+        mapping = ndb.Key(UserEmail, email).get()
+        if mapping:
+            return mapping.userId
+
+        # profiles created before UserEmail existed keep their id
+        profile_key = Profile.query(Profile.mainEmail == email).get(keys_only=True)
+        if profile_key:
+            user_id = profile_key.id()
         else:
-            return str(uuid.uuid1().get_hex())
+            user_id = str(uuid.uuid1().get_hex())
+        # transactional, so concurrent first requests agree on one id
+        return UserEmail.get_or_insert(email, userId=user_id).userId
+
+
+def parseConferenceKey(webSafeKey):
+    """Return the Conference key encoded in webSafeKey, or None if it is
+    malformed or the key of another kind (no datastore access)."""
+    try:
+        key = ndb.Key(urlsafe=webSafeKey)
+    except Exception:
+        # malformed keys raise a variety of decoding errors
+        return None
+    if key.kind() != 'Conference':
+        return None
+    return key
+
+
+def _getOAuthUserId(token):
+    """Return the user id for an OAuth token, checking the in-process and
+    memcache tiers before asking the tokeninfo endpoint."""
+    digest = hashlib.sha1(token).hexdigest()
+    user_id = _tokenCache.get(digest)
+    if user_id is not None:
+        return user_id
+
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % digest)
+    if cached is not None:
+        user_id, expires = cached
+        # only for the time the token has left
+        ttl = int(expires - time.time())
+        if ttl > 0:
+            _tokenCache.set(digest, user_id, ttl=ttl)
+        return user_id
+
+    user_id, expires_in = _sharedTokenInfo(digest, token)
+    ttl = TOKEN_CACHE_TTL
+    if expires_in is not None:
+        ttl = min(int(expires_in), TOKEN_CACHE_TTL)
+    # note memcache treats time=0 as "never expires"
+    if user_id and ttl > 0:
+        _tokenCache.set(digest, user_id, ttl=ttl)
+        memcache.set(MEMCACHE_TOKEN_KEY % digest,
+                     (user_id, time.time() + ttl), time=ttl)
+    return user_id
+
+
+class _Lookup(object):
+    """A tokeninfo lookup other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = ('', None)
+
+
+def _sharedTokenInfo(digest, token):
+    """Run _fetchTokenInfo once per token, however many requests ask."""
+    with _inflightLock:
+        lookup = _inflight.get(digest)
+        leader = lookup is None
+        if leader:
+            lookup = _inflight[digest] = _Lookup()
+
+    if not leader:
+        lookup.done.wait(TOKENINFO_DEADLINE * TOKENINFO_ATTEMPTS)
+        return lookup.result
+
+    try:
+        lookup.result = _fetchTokenInfo(token)
+    finally:
+        with _inflightLock:
+            del _inflight[digest]
+        lookup.done.set()
+    return lookup.result
+
+
+def _fetchTokenInfo(token):
+    """Verify token with tokeninfo, returning (user_id, expires_in);
+    user_id is '' if the token could not be verified."""
+    # only needed when a token is not cached yet
+    from google.appengine.api import urlfetch
+
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+        urlfetch.make_fetch_call(rpc, TOKENINFO_URL.format(token_type, token))
+        try:
+            response = rpc.get_result()
+        except urlfetch.Error:
+            # deadline exceeded / connection failure: just try again
+            continue
+        if response.status_code == 200:
+            info = json.loads(response.content)
+            return (info.get('user_id', ''), info.get('expires_in'))
+        elif response.status_code == 400 and 'invalid_token' in response.content:
+            if token_type == 'access_token':
+                break
+            token_type = 'access_token'
+    return ('', None)